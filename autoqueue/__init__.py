@@ -352,7 +352,8 @@ class AutoQueueBase(object):
         song = self.cache.last_song = self.cache.last_songs.pop()
         self.analyze_and_callback(
             song.get_filename(), reply_handler=self.analyzed,
-            empty_handler=self.gaia_reply_handler)
+            empty_handler=self.gaia_reply_handler,
+            priority=self.get_analysis_priority(song))
 
     def analyzed(self):
         song = self.cache.last_song
@@ -361,15 +362,17 @@ class AutoQueueBase(object):
             return
         if self.use_gaia:
             print('Get similar tracks for: %s' % filename)
-            request = self.requests.get_first()
-            if request:
-                request = ensure_string(request)
-                if request:
-                    self.similarity.get_ordered_gaia_tracks_by_request(
-                        filename, self.configuration.number, request,
-                        reply_handler=self.gaia_reply_handler,
-                        error_handler=self.error_handler, timeout=TIMEOUT)
-                    return
+            requests = [
+                request for request in (
+                    ensure_string(request)
+                    for request in self.requests.get_all())
+                if request]
+            if requests:
+                self.similarity.get_ordered_gaia_tracks_by_requests(
+                    filename, self.configuration.number, requests,
+                    reply_handler=self.gaia_reply_handler,
+                    error_handler=self.error_handler, timeout=TIMEOUT)
+                return
             self.similarity.get_ordered_gaia_tracks(
                 filename, self.configuration.number,
                 reply_handler=self.gaia_reply_handler,
@@ -421,7 +424,8 @@ class AutoQueueBase(object):
     def done(self):
         """Analyze the last song and stop."""
         song = self.get_last_songs()[-1]
-        self.analyze_and_callback(song.get_filename())
+        self.analyze_and_callback(
+            song.get_filename(), priority=self.get_analysis_priority(song))
         self.cache.running = False
 
     def similar_tracks_handler(self, results):
@@ -483,17 +487,22 @@ class AutoQueueBase(object):
         song = self.cache.last_song = self.cache.last_songs.pop()
         self.analyze_and_callback(
             song.get_filename(), reply_handler=self.analyzed,
-            empty_handler=self.gaia_reply_handler)
+            empty_handler=self.gaia_reply_handler,
+            priority=self.get_analysis_priority(song))
+
+    def get_analysis_priority(self, song):
+        """Get the analysis priority class for a song."""
+        return 'now_playing' if song is self.cache.song else 'queued'
 
     def analyze_and_callback(self, filename, reply_handler=no_op,
-                             empty_handler=no_op):
+                             empty_handler=no_op, priority='now_playing'):
         filename = ensure_string(filename)
         if not filename:
             return
         if self.use_gaia:
             print('Analyzing: %s' % filename)
-            self.similarity.analyze_track(
-                filename, reply_handler=reply_handler,
+            self.similarity.analyze_track_with_priority(
+                filename, priority, reply_handler=reply_handler,
                 error_handler=self.error_handler, timeout=TIMEOUT)
         else:
             empty_handler([])
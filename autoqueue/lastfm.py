@@ -0,0 +1,199 @@
+"""Fetch similarity data from last.fm.
+
+Calls run on a bounded pool of worker threads sharing one HTTP session, are
+rate limited by a token bucket, and identical calls that are in flight at
+the same time are coalesced into one.
+"""
+from __future__ import absolute_import, division, print_function
+
+from builtins import object
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, RLock
+from time import monotonic, sleep
+
+import requests
+from future import standard_library
+from requests.adapters import HTTPAdapter
+
+standard_library.install_aliases()
+
+API_URL = 'https://ws.audioscrobbler.com/2.0/'
+
+# last.fm error codes. Invalid parameters is also what we get for unknown
+# artists and tracks.
+INVALID_PARAMETERS = 6
+RATE_LIMIT_EXCEEDED = 29
+
+# Seconds to stop calling last.fm after it tells us to slow down.
+THROTTLE_BACKOFF = 60
+
+
+class WSError(Exception):
+
+    """Error returned by the last.fm web service."""
+
+    def __init__(self, code, message):
+        super(WSError, self).__init__(code, message)
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return 'last.fm error %s: %s' % (self.code, self.message)
+
+
+class NetworkError(Exception):
+
+    """The last.fm web service could not be reached."""
+
+
+class MalformedResponseError(Exception):
+
+    """The last.fm web service returned something we do not understand."""
+
+
+class TokenBucket(object):
+
+    """Rate limiter allowing bursts of up to capacity calls."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self._lock = Lock()
+
+    def pause(self, seconds):
+        """Hand out no tokens for a while, and start empty afterwards."""
+        with self._lock:
+            self.tokens = 0
+            self.updated = max(self.updated, monotonic() + seconds)
+
+    def try_acquire(self):
+        """Take a token if one is available, else return the wait time."""
+        with self._lock:
+            now = monotonic()
+            if now < self.updated:
+                return self.updated - now
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available, and take it."""
+        wait = self.try_acquire()
+        while wait:
+            sleep(wait)
+            wait = self.try_acquire()
+
+
+def as_list(items):
+    """Return last.fm's representation of zero or more items as a list."""
+    if not items:
+        return []
+    if isinstance(items, dict):
+        return [items]
+    return items
+
+
+class LastFMFetcher(object):
+
+    """Concurrent, rate limited and coalescing last.fm client."""
+
+    def __init__(self, api_key, url=API_URL, workers=4, rate=4, burst=5,
+                 timeout=10):
+        self.api_key = api_key
+        self.url = url
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._in_flight = {}
+        # Reentrant, because a future that is already done runs its
+        # callbacks right away.
+        self._lock = RLock()
+
+    def submit(self, method, parse, **params):
+        """Call a last.fm method on the worker pool.
+
+        Returns a future for the parsed response. Calls identical to one
+        that has not finished yet share its future.
+
+        """
+        key = (method, tuple(sorted(
+            (name, value.lower()) for name, value in params.items())))
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self.executor.submit(self.call, method, parse, params)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda _: self._forget(key))
+        return future
+
+    def _forget(self, key):
+        with self._lock:
+            del self._in_flight[key]
+
+    def pending(self):
+        """Return the number of calls that have not finished yet."""
+        with self._lock:
+            return len(self._in_flight)
+
+    def call(self, method, parse, params):
+        """Call a last.fm method and return the parsed response."""
+        self.bucket.acquire()
+        query = dict(
+            params, method=method, api_key=self.api_key, format='json',
+            autocorrect='1')
+        try:
+            response = self.session.get(
+                self.url, params=query, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise NetworkError(e)
+        if response.status_code == 429:
+            self.bucket.pause(THROTTLE_BACKOFF)
+            raise WSError(RATE_LIMIT_EXCEEDED, 'Rate limit exceeded')
+        try:
+            data = response.json()
+        except ValueError:
+            raise MalformedResponseError(response.text[:200])
+        if 'error' in data:
+            if data['error'] == RATE_LIMIT_EXCEEDED:
+                self.bucket.pause(THROTTLE_BACKOFF)
+            raise WSError(data['error'], data.get('message'))
+        try:
+            return parse(data)
+        except (KeyError, TypeError, ValueError) as e:
+            raise MalformedResponseError(repr(e))
+
+    @staticmethod
+    def parse_similar_tracks(data):
+        """Return (match, artist name, title) tuples."""
+        return [
+            (float(track['match']), track['artist']['name'], track['name'])
+            for track in as_list(data['similartracks'].get('track'))]
+
+    @staticmethod
+    def parse_similar_artists(data):
+        """Return (match, artist name) tuples."""
+        return [
+            (float(artist['match']), artist['name'])
+            for artist in as_list(data['similarartists'].get('artist'))]
+
+    def get_similar_tracks(self, artist_name, title):
+        """Get a future for the tracks similar to a track."""
+        return self.submit(
+            'track.getSimilar', self.parse_similar_tracks, artist=artist_name,
+            track=title)
+
+    def get_similar_artists(self, artist_name):
+        """Get a future for the artists similar to an artist."""
+        return self.submit(
+            'artist.getSimilar', self.parse_similar_artists,
+            artist=artist_name)
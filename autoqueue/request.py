@@ -40,6 +40,10 @@ class Requests(object):
         for row in self.cursor.fetchall():
             return row[0]
 
+    def get_all(self):
+        self.cursor.execute("SELECT filename FROM requests ORDER BY id;")
+        return [row[0] for row in self.cursor.fetchall()]
+
     def pop(self, filename):
         self.cursor.execute(
             "DELETE FROM requests WHERE filename = ? ORDER BY id LIMIT 1;",
@@ -19,34 +19,61 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
 """
 from __future__ import absolute_import, print_function
 
+import hashlib
 import json
 import os
 import sqlite3
 import subprocess
+import tempfile
+from abc import ABCMeta, abstractmethod
+from array import array
 from builtins import object, str
-from datetime import datetime, timedelta
-from threading import Thread
-from time import sleep, strptime, time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import wraps
+from heapq import heappop, heappush
+from itertools import count
+from multiprocessing import cpu_count
+from shutil import which
+from threading import BoundedSemaphore, Event, Lock, Thread, Timer
+from time import sleep, time
+from urllib.request import pathname2url
 
 import dbus
 import dbus.service
 from dbus.mainloop.glib import DBusGMainLoop
-from dbus.service import method
+from dbus.service import method, signal
 from future import standard_library
-from gi.repository import GObject
-from pylast import LastFMNetwork, MalformedResponseError, NetworkError, WSError
-from queue import Empty, LifoQueue, PriorityQueue, Queue
+from future.utils import with_metaclass
+from gi.repository import GLib, GObject
+from queue import Empty, PriorityQueue, Queue
+from autoqueue.lastfm import (
+    INVALID_PARAMETERS, RATE_LIMIT_EXCEEDED, LastFMFetcher,
+    MalformedResponseError, NetworkError, WSError)
 from autoqueue.utilities import player_get_data_dir
 
 standard_library.install_aliases()
 
 try:
-    from gaia2 import DataSet, transform, DistanceFunctionFactory, View, Point
-    import yaml
+    from gaia2 import (
+        DataSet, transform, DistanceFunctionFactory, View, Point, PointLayout,
+        RealType, StringType)
     GAIA = True
 except ImportError:
     GAIA = False
 
+try:
+    import numpy as np
+    NUMPY = True
+except ImportError:
+    NUMPY = False
+
+try:
+    import hnswlib
+    HNSW = True
+except ImportError:
+    HNSW = False
+
 
 DBusGMainLoop(set_as_default=True)
 
@@ -59,41 +86,1005 @@ DBUS_PATH = '/org/autoqueue/Similarity'
 # http://www.last.fm/api/account
 API_KEY = "09d0975a99a4cab235b731d31abf0057"
 
-# XXX: obviously make this configurable
-ESSENTIA_EXTRACTOR_PATH = \
-    '/home/eric/github/essentia/build/src/examples/streaming_extractor_music'
+ESSENTIA_EXTRACTOR_PATH = os.environ.get(
+    'AUTOQUEUE_ESSENTIA_EXTRACTOR',
+    '/home/eric/github/essentia/build/src/examples/streaming_extractor_music')
+
+# Fraction of the CPU cores that extractors may use at the same time, and
+# the scheduling priority they run with. IO class 3 is idle: the extractors
+# only read from disk when nothing else wants to.
+EXTRACTOR_CPU_BUDGET = .5
+EXTRACTOR_NICENESS = 19
+EXTRACTOR_IO_CLASS = 3
+
+# The file's tags, which differ from file to file and are never compared.
+TAG_DESCRIPTORS = ('tags',)
+
+# Extractor output that NumpyAnalysis never uses: frame level data and the
+# file's tags. GaiaAnalysis only drops the tags, because a transformed
+# dataset maps new points through a history fitted on points that still had
+# the frame level data, and its transform removes that itself.
+PRUNED_DESCRIPTORS = (
+    'beats_position', 'bpm_estimates', 'bpm_intervals', 'onset_times',
+    'oddtoevenharmonicenergyratio') + TAG_DESCRIPTORS
+
+# Acoustic similarity backend: 'gaia', or 'numpy' which needs no gaia.
+ACOUSTIC_BACKEND = os.environ.get(
+    'AUTOQUEUE_ACOUSTIC_BACKEND', 'gaia' if GAIA else 'numpy')
+
+# Number of dimensions analysis results are projected to for comparison.
+PCA_DIMENSION = 30
+
+# The numpy backend fits its projection again when the number of files has
+# grown by this factor since the last fit.
+REFIT_GROWTH = 2
+
+# With hnswlib installed, the numpy backend searches datasets of at least
+# ANN_MIN_SIZE files with an approximate nearest neighbour index. ANN_EF
+# trades speed for recall: higher values find more of the true nearest
+# neighbours, more slowly. ANN_M and ANN_EF_CONSTRUCTION set the quality
+# of the index itself.
+ANN_MIN_SIZE = 10000
+ANN_EF = int(os.environ.get('AUTOQUEUE_ANN_EF', 100))
+ANN_M = 16
+ANN_EF_CONSTRUCTION = 200
+
+# Changes to the acoustic dataset are journaled, and the dataset is only
+# rewritten when this many changes have been journaled, or the oldest
+# journaled change is this many seconds old.
+COMPACT_CHANGES = 500
+COMPACT_INTERVAL = 30 * 60
 
 ADD = 'add'
 REMOVE = 'remove'
+LOADED = 'loaded'
+
+# Seconds miximize waits for the selected files to be analyzed. This stays
+# under the default D-Bus reply timeout of 25 seconds.
+MIXIMIZE_TIMEOUT = 20
+
+# Number of files per part of the order miximize jobs hand out, and the
+# stages they report progress for.
+MIXIMIZE_CHUNK_SIZE = 10
+ANALYZING = 'analyzing'
+ORDERING = 'ordering'
+
+# Whether miximize scales the projected vectors of a selection to unit
+# variance in every dimension before comparing them, which spreads out
+# selections of songs that are all alike.
+MIXIMIZE_NORMALIZE = bool(int(os.environ.get(
+    'AUTOQUEUE_MIXIMIZE_NORMALIZE', 0)))
+
+# Analysis priority classes, most urgent first.
+NOW_PLAYING = 'now_playing'
+QUEUED = 'queued'
+REQUESTED = 'requested'
+BULK = 'bulk'
+PRIORITIES = (NOW_PLAYING, QUEUED, REQUESTED, BULK)
+
+# Maximum number of artist and track ids to keep in memory.
+ID_CACHE_SIZE = 100000
+
+# Maximum number of rows to look up in a single statement, which keeps the
+# number of bound variables under SQLite's limit.
+SQL_CHUNK_SIZE = 400
+
+
+DAY = 24 * 60 * 60
+
+# Seconds to wait before asking last.fm again about a track or artist it had
+# nothing for, by kind of miss. Every repeated miss doubles the wait, up to
+# the cache time.
+MISS_TTL = {
+    'empty': 7 * DAY,
+    'not_found': 7 * DAY,
+    'error': DAY,
+    'network': 15 * 60}
+
+
+def chunked(items, size=SQL_CHUNK_SIZE):
+    """Split a list into lists of at most size items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def when_done(futures, callback, timeout=None):
+    """Call back once all futures are done, or after timeout seconds.
+
+    The callback is called exactly once, with True if all futures are done
+    and False if it timed out, from the thread that finished the last
+    future, or from a timer thread.
+
+    """
+    lock = Lock()
+    state = {'pending': len(futures), 'called': False}
+    timer = None
+
+    def finish(complete):
+        with lock:
+            if state['called']:
+                return
+            state['called'] = True
+        if timer is not None:
+            timer.cancel()
+        callback(complete)
+
+    def done(_):
+        with lock:
+            state['pending'] -= 1
+            complete = not state['pending']
+        if complete:
+            finish(True)
+
+    if timeout is not None:
+        timer = Timer(timeout, finish, (False,))
+        timer.daemon = True
+        timer.start()
+    if not futures:
+        finish(True)
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def reply_when_done(future, reply_handler, error_handler):
+    """Answer an asynchronous D-Bus call from the main loop."""
+    def reply(_):
+        try:
+            GLib.idle_add(reply_handler, future.result())
+        except Exception as e:
+            GLib.idle_add(error_handler, e)
+
+    future.add_done_callback(reply)
+
+
+def in_main_loop(function):
+    """Wrap a function to be called from the main loop, e.g. to emit D-Bus
+    signals from other threads."""
+    def call(*args):
+        GLib.idle_add(function, *args)
+
+    return call
+
+
+def classify_miss(error):
+    """Get the kind of miss for a last.fm error, or None if it is our fault.
+
+    """
+    if isinstance(error, NetworkError):
+        return 'network'
+    if isinstance(error, WSError):
+        if error.code == RATE_LIMIT_EXCEEDED:
+            return None
+        if error.code == INVALID_PARAMETERS:
+            return 'not_found'
+    return 'error'
+
+
+def interactive(method):
+    """Mark a Similarity method as a lookup somebody is waiting for."""
+    @wraps(method)
+    def wrapper(similarity, *args, **kwargs):
+        with similarity.interactive_lock:
+            similarity.interactive_lookups += 1
+        try:
+            return method(similarity, *args, **kwargs)
+        finally:
+            with similarity.interactive_lock:
+                similarity.interactive_lookups -= 1
+                similarity.last_interactive = time()
+    return wrapper
 
 
 class SQLCommand(object):
 
-    """A SQL command object."""
+    """A SQL command object.
 
-    def __init__(self, sql_statements):
+    With many=True the parameters are a sequence of rows, and the statement
+    is run once for each of them with executemany.
+
+    """
+
+    _sequence = count()
+
+    def __init__(self, sql_statements, many=False):
         self.sql = sql_statements
+        self.many = many
         self.result_queue = Queue()
+        # Commands with equal priority are executed in the order in which
+        # they were created.
+        self.sequence = next(self._sequence)
 
+    def __lt__(self, other):
+        return self.sequence < other.sequence
 
-class GaiaAnalysis(Thread):
+    def is_read(self):
+        """Check whether the command only reads from the database."""
+        return self.sql[0].lstrip().upper().startswith('SELECT')
 
-    """Gaia acoustic analysis and comparison."""
+    def is_stop(self):
+        """Check whether the command tells the database thread to stop."""
+        return self.sql == ('STOP',)
 
-    def __init__(self, db_path, queue):
-        super(GaiaAnalysis, self).__init__()
-        self.gaia_db_path = db_path
-        self.gaia_db = None
+    def run(self, cursor):
+        """Run the command and return the result rows."""
+        if self.many:
+            cursor.executemany(*self.sql)
+        else:
+            cursor.execute(*self.sql)
+        return cursor.fetchall()
+
+    def execute(self, cursor):
+        """Run the command, reporting rather than raising errors."""
+        try:
+            return self.run(cursor)
+        except Exception as e:
+            print(e, repr(self.sql))
+            return []
+
+
+class SQLTransaction(SQLCommand):
+
+    """A list of SQL commands that succeed or fail together.
+
+    The result is that of the last command.
+
+    """
+
+    def __init__(self, commands):
+        super(SQLTransaction, self).__init__(
+            [command.sql for command in commands])
+        self.commands = commands
+
+    def is_read(self):
+        return False
+
+    def is_stop(self):
+        return False
+
+    def run(self, cursor):
+        if not cursor.connection.in_transaction:
+            cursor.execute('BEGIN IMMEDIATE;')
+        cursor.execute('SAVEPOINT sql_transaction;')
+        try:
+            result = []
+            for command in self.commands:
+                result = command.run(cursor)
+        except Exception:
+            cursor.execute('ROLLBACK TO sql_transaction;')
+            raise
+        finally:
+            cursor.execute('RELEASE sql_transaction;')
+        return result
+
+
+def flatten_descriptors(descriptors, prefix=''):
+    """Flatten nested extractor output to a {dotted name: value} dict."""
+    flat = {}
+    for key, value in descriptors.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten_descriptors(value, name + '.'))
+        else:
+            flat[name] = value
+    return flat
+
+
+def extractor_available(path):
+    """Check whether an essentia extractor exists and can be run."""
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def prune_descriptors(pairs, pruned_descriptors=PRUNED_DESCRIPTORS):
+    """Build a JSON object, leaving out unused descriptors."""
+    return {
+        key: value for key, value in pairs
+        if not any(pruned in key for pruned in pruned_descriptors)}
+
+
+def is_number(value):
+    """Check whether value is an int or float."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def get_shape(value):
+    """Get the shape of a real valued descriptor, or None for labels."""
+    if is_number(value):
+        return []
+    if isinstance(value, list):
+        if all(is_number(v) for v in value):
+            return [len(value)]
+        if value and all(
+                isinstance(row, list) and len(row) == len(value[0]) and
+                all(is_number(v) for v in row) for row in value):
+            return [len(value), len(value[0])]
+    return None
+
+
+def pack_descriptors(descriptors):
+    """Pack flat descriptors into a layout, a float32 vector and labels.
+
+    The layout lists (name, shape) pairs, where the shape is None for
+    label (string) descriptors.
+
+    """
+    layout = []
+    vector = array('f')
+    labels = []
+    for name in sorted(descriptors):
+        value = descriptors[name]
+        shape = get_shape(value)
+        layout.append((name, shape))
+        if shape is None:
+            labels.append(value)
+        elif not shape:
+            vector.append(value)
+        elif len(shape) == 1:
+            vector.extend(value)
+        else:
+            for row in value:
+                vector.extend(row)
+    return layout, vector, labels
+
+
+def unpack_descriptors(layout, vector, labels):
+    """Inverse of pack_descriptors."""
+    descriptors = {}
+    labels = iter(labels)
+    offset = 0
+    for name, shape in layout:
+        if shape is None:
+            descriptors[name] = next(labels)
+            continue
+        if not shape:
+            descriptors[name] = vector[offset]
+            offset += 1
+            continue
+        size = shape[0] if len(shape) == 1 else shape[0] * shape[1]
+        values = vector[offset:offset + size].tolist()
+        offset += size
+        if len(shape) == 2:
+            values = [
+                values[i:i + shape[1]] for i in range(0, size, shape[1])]
+        descriptors[name] = values
+    return descriptors
+
+
+class AnalysisCache(object):
+
+    """Persistent cache of extractor results.
+
+    Results are stored per content hash of the audio file, in compact
+    packed form. A second table remembers the hash for every path, along
+    with the size and modification time it was computed for, so unchanged
+    files are not hashed again, while renamed, moved or duplicated files
+    are only hashed and never analyzed again.
+
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = Lock()
+        self.layouts = {}
+        with self.lock:
+            self.connection.executescript(
+                "PRAGMA journal_mode=WAL;"
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY,"
+                " size INTEGER, mtime INTEGER, hash TEXT);"
+                "CREATE TABLE IF NOT EXISTS layouts (id INTEGER PRIMARY KEY,"
+                " layout TEXT UNIQUE);"
+                "CREATE TABLE IF NOT EXISTS analyses (hash TEXT PRIMARY KEY,"
+                " layout INTEGER, vector BLOB, labels TEXT, pruned TEXT);")
+            columns = [
+                row[1] for row in self.connection.execute(
+                    "PRAGMA table_info(analyses);")]
+            if 'pruned' not in columns:
+                self.connection.execute(
+                    "ALTER TABLE analyses ADD COLUMN pruned TEXT;")
+                self.connection.commit()
+
+    @staticmethod
+    def hash_file(path):
+        """Compute the content hash of a file."""
+        digest = hashlib.sha1()
+        with open(path, 'rb') as audio:
+            for block in iter(lambda: audio.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get_hash(self, path, compute=True):
+        """Get the content hash for a path.
+
+        Returns None if the file changed since the hash was computed, or is
+        unknown, and compute is False.
+
+        """
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            print(e)
+            return None
+        with self.lock:
+            for row in self.connection.execute(
+                    "SELECT hash FROM files WHERE path = ? AND size = ? AND"
+                    " mtime = ?;", (path, stat.st_size, stat.st_mtime_ns)):
+                return row[0]
+        if not compute:
+            return None
+        content_hash = self.hash_file(path)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime, hash) VALUES"
+                " (?, ?, ?, ?);",
+                (path, stat.st_size, stat.st_mtime_ns, content_hash))
+            self.connection.commit()
+        return content_hash
+
+    def get_layout(self, layout_id):
+        """Get a layout by id."""
+        layout = self.layouts.get(layout_id)
+        if layout is None:
+            for row in self.connection.execute(
+                    "SELECT layout FROM layouts WHERE id = ?;", (layout_id,)):
+                layout = self.layouts[layout_id] = json.loads(row[0])
+        return layout
+
+    def get_layout_id(self, layout):
+        """Get the id for a layout, adding it if needed."""
+        text = json.dumps(layout)
+        self.connection.execute(
+            "INSERT OR IGNORE INTO layouts (layout) VALUES (?);", (text,))
+        for row in self.connection.execute(
+                "SELECT id FROM layouts WHERE layout = ?;", (text,)):
+            return row[0]
+
+    def get(self, content_hash):
+        """Get the flat descriptors for a content hash, or None."""
+        with self.lock:
+            for layout_id, blob, labels in self.connection.execute(
+                    "SELECT layout, vector, labels FROM analyses WHERE hash ="
+                    " ?;", (content_hash,)):
+                vector = array('f')
+                vector.frombytes(blob)
+                return unpack_descriptors(
+                    self.get_layout(layout_id), vector, json.loads(labels))
+        return None
+
+    def put(self, content_hash, descriptors, pruned=()):
+        """Store the flat descriptors for a content hash.
+
+        pruned lists the descriptors that were dropped from them.
+
+        """
+        layout, vector, labels = pack_descriptors(descriptors)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO analyses (hash, layout, vector,"
+                " labels, pruned) VALUES (?, ?, ?, ?, ?);",
+                (content_hash, self.get_layout_id(layout),
+                 sqlite3.Binary(vector.tobytes()), json.dumps(labels),
+                 json.dumps(sorted(pruned))))
+            self.connection.commit()
+
+    def get_pruned(self, content_hash):
+        """Get the descriptors dropped from the results for a content hash.
+
+        Returns None if there are no results. Results stored before this
+        was recorded count as pruned of all PRUNED_DESCRIPTORS.
+
+        """
+        with self.lock:
+            for row in self.connection.execute(
+                    "SELECT pruned FROM analyses WHERE hash = ?;",
+                    (content_hash,)):
+                if row[0] is None:
+                    return PRUNED_DESCRIPTORS
+                return tuple(json.loads(row[0]))
+        return None
+
+    def get_packed(self, hashes):
+        """Get packed results: {content hash: (layout id, layout, vector)}.
+
+        The vectors are returned as the raw float32 bytes.
+
+        """
+        packed = {}
+        with self.lock:
+            for chunk in chunked(hashes):
+                for content_hash, layout_id, blob in self.connection.execute(
+                        "SELECT hash, layout, vector FROM analyses WHERE hash"
+                        " IN (%s);" % ', '.join('?' * len(chunk)), chunk):
+                    packed[content_hash] = (
+                        layout_id, self.get_layout(layout_id), blob)
+        return packed
+
+    def get_layouts(self, hashes):
+        """Get the distinct layouts of the results for content hashes."""
+        layout_ids = set()
+        with self.lock:
+            for chunk in chunked(hashes):
+                layout_ids.update(
+                    row[0] for row in self.connection.execute(
+                        "SELECT DISTINCT layout FROM analyses WHERE hash IN"
+                        " (%s);" % ', '.join('?' * len(chunk)), chunk))
+            return [self.get_layout(layout_id) for layout_id in layout_ids]
+
+    def forget_path(self, path):
+        """Forget the hash for a path, keeping the analysis."""
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM files WHERE path = ?;", (path,))
+            self.connection.commit()
+
+
+class DatasetJournal(object):
+
+    """Append only log of the changes made to a saved gaia dataset.
+
+    Every line is a JSON list: [ADD, filename, content hash] or [REMOVE,
+    filename]. The analysis results themselves live in the analysis cache,
+    so replaying the journal on top of the last saved dataset restores the
+    dataset as it was in memory.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.changes = 0
+        self.first_change = None
+        self.journal = open(path, 'a')
+
+    def entries(self):
+        """Read the journaled changes, skipping a torn last line."""
+        if not os.path.isfile(self.path):
+            return []
+        entries = []
+        with open(self.path, 'r') as journal:
+            for line in journal:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    print('skipping corrupt journal entry: %r' % line)
+        return entries
+
+    def append(self, *entry):
+        """Journal a change."""
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        self.changed()
+
+    def changed(self, number=1):
+        """Count changes that are not in the saved dataset yet."""
+        if not self.changes:
+            self.first_change = time()
+        self.changes += number
+
+    def sync(self):
+        """Make sure journaled changes survive a crash."""
+        if self.changes:
+            os.fsync(self.journal.fileno())
+
+    def is_due(self, changes=COMPACT_CHANGES, interval=COMPACT_INTERVAL):
+        """Check whether the dataset should be saved."""
+        return self.changes >= changes or (
+            self.changes and time() - self.first_change >= interval)
+
+    def clear(self):
+        """Empty the journal after the dataset was saved."""
+        self.journal.truncate(0)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.changes = 0
+        self.first_change = None
+
+
+class AnalysisQueue(Queue):
+
+    """Queue of analysis work, ordered by priority class.
+
+    Work is put on the queue as (command, filename, priority) tuples, where
+    the priority defaults to BULK, and taken off as (command, filename)
+    tuples. Loaded results and removals come first, then files to analyze
+    by priority class, most recently added first within a class. A file
+    that is already pending is not added again, but moved to the more
+    urgent class if needed.
+
+    """
+
+    def _init(self, maxsize):
+        self.heap = []
+        self.pending = {}
+        self.other = 0
+        self.sequence = count()
+
+    def _qsize(self):
+        return len(self.pending) + self.other
+
+    def _put(self, item):
+        command, filename = item[:2]
+        if command == ADD:
+            rank = PRIORITIES.index(item[2] if len(item) > 2 else BULK)
+            if self.pending.get(filename, rank + 1) <= rank:
+                return
+            self.pending[filename] = rank
+        else:
+            rank = -1
+            self.other += 1
+        heappush(self.heap, (rank, -next(self.sequence), command, filename))
+
+    def _get(self):
+        while True:
+            rank, _, command, filename = heappop(self.heap)
+            if command != ADD:
+                self.other -= 1
+                return command, filename
+            # Skip entries for files that were moved to a more urgent class.
+            if self.pending.get(filename) == rank:
+                del self.pending[filename]
+                return command, filename
+
+    def depths(self):
+        """Get the number of files pending per priority class."""
+        with self.mutex:
+            depths = {priority: 0 for priority in PRIORITIES}
+            for rank in self.pending.values():
+                depths[PRIORITIES[rank]] += 1
+        return depths
+
+
+class AcousticAnalysis(with_metaclass(ABCMeta, Thread)):
+
+    """Acoustic analysis and comparison.
+
+    Audio files are analyzed by a pool of essentia extractor processes,
+    but only this thread ever changes the dataset. Subclasses decide how
+    the dataset is stored and searched.
+
+    """
+
+    # Descriptors dropped from extractor output before it is cached.
+    pruned_descriptors = TAG_DESCRIPTORS
+
+    def __init__(self, db_path, queue, cache_path,
+                 extractor_path=ESSENTIA_EXTRACTOR_PATH,
+                 cpu_budget=EXTRACTOR_CPU_BUDGET, niceness=EXTRACTOR_NICENESS,
+                 io_class=EXTRACTOR_IO_CLASS, compact_changes=COMPACT_CHANGES,
+                 compact_interval=COMPACT_INTERVAL,
+                 normalize_selections=MIXIMIZE_NORMALIZE):
+        super(AcousticAnalysis, self).__init__()
+        self.db_path = db_path
+        self.cache = AnalysisCache(cache_path)
+        self.journal = DatasetJournal(db_path + '.journal')
+        self.compact_changes = compact_changes
+        self.compact_interval = compact_interval
         self.commands = {
             ADD: self._analyze,
+            LOADED: self._add_point,
             REMOVE: self._remove_point}
         self.queue = queue
         self.transformed = False
+        self.extractor_path = extractor_path
+        self.niceness = niceness
+        self.io_class = io_class
+        self.normalize_selections = normalize_selections
+        workers = max(1, int(cpu_count() * cpu_budget))
+        self.extractors = ThreadPoolExecutor(max_workers=workers)
+        self.extractor_slots = BoundedSemaphore(workers)
+        self.extracting = set()
+        self.waiters = {}
+        self.waiters_lock = Lock()
+        self.ready = Event()
+
+    @abstractmethod
+    def load(self):
+        """Load the saved dataset, or start an empty one."""
+
+    @abstractmethod
+    def save(self):
+        """Transform the dataset if needed, and save it."""
+
+    @abstractmethod
+    def size(self):
+        """Get the number of files in the dataset."""
+
+    @abstractmethod
+    def contains(self, filename):
+        """Check whether a file is in the dataset."""
+
+    @abstractmethod
+    def add_point(self, filename, content_hash):
+        """Add the cached analysis results for a content hash.
+
+        Returns whether the file was added.
+
+        """
+
+    @abstractmethod
+    def remove_point(self, filename):
+        """Remove a file from the dataset, returning whether it was there."""
+
+    @abstractmethod
+    def get_neighbours(self, filename, number, requests=()):
+        """Get (score, filename) tuples for the nearest neighbours of a file.
+
+        When there are requests, neighbours are scored by their distance
+        to the nearest requested file instead, and only the best half is
+        kept.
+
+        """
+
+    @abstractmethod
+    def get_distance_matrix(self, filenames):
+        """Get the distances between files miximize orders them by.
+
+        Returns a float32 matrix with numpy, and a list of rows without.
+
+        """
+
+    def initialize(self):
+        """Handle more expensive initialization."""
+        self.load()
+        print("songs in db: %d" % self.size())
+        self.replay_journal()
+
+    def selection_distances(self, filenames, names, vectors):
+        """Get the distances between files from the projected vectors of
+        the names among them, in the same order.
+
+        Files without a vector are infinitely far from all others.
+
+        """
+        if self.normalize_selections and len(names) > 1:
+            vectors = standardize(vectors)
+        if len(names) == len(filenames):
+            return pairwise_distances(vectors)
+        distances = np.full(
+            (len(filenames), len(filenames)), np.inf, dtype=np.float32)
+        np.fill_diagonal(distances, 0)
+        if names:
+            positions = {
+                filename: index for index, filename in enumerate(filenames)}
+            rows = [positions[name] for name in names]
+            distances[np.ix_(rows, rows)] = pairwise_distances(vectors)
+        return distances
+
+    def analyze(self, filenames, priority=BULK):
+        """Queue audio files for analysis.
+
+        Returns a completion handle for every file: a future that is
+        resolved with whether the file made it into the dataset, once it
+        is done.
+
+        """
+        handles = []
+        with self.waiters_lock:
+            for filename in filenames:
+                handle = Future()
+                self.waiters.setdefault(filename, []).append(handle)
+                handles.append(handle)
+        for filename in filenames:
+            self.queue.put((ADD, filename, priority))
+        return handles
+
+    def resolve(self, filename, analyzed):
+        """Complete the handles for a file."""
+        with self.waiters_lock:
+            handles = self.waiters.pop(filename, [])
+        for handle in handles:
+            handle.set_result(analyzed)
+
+    def _analyze(self, filename):
+        """Analyze an audio file.
+
+        Unless the results are cached, the extraction runs in the
+        background, and the result is queued as a LOADED command.
+
+        """
+        if self.contains(filename):
+            self.resolve(filename, True)
+            return
+        if filename in self.extracting:
+            return
+        content_hash = self.cache.get_hash(filename, compute=False)
+        if content_hash is not None and self.usable(content_hash):
+            self._add_point(filename)
+            return
+        # Wait for a free extractor, so the queue keeps deciding what to
+        # analyze next.
+        self.extractor_slots.acquire()
+        self.extracting.add(filename)
+        self.extractors.submit(self.extract, filename)
+
+    def extract(self, filename):
+        """Run the extractor if needed and queue the result for loading."""
+        try:
+            content_hash = self.cache.get_hash(filename)
+            if content_hash is None or self.usable(content_hash):
+                return
+            handle, signame = tempfile.mkstemp(suffix='.sig')
+            os.close(handle)
+            try:
+                if self.essentia_analyze(filename.encode('utf-8'), signame):
+                    self.cache.put(
+                        content_hash, self.load_descriptors(signame),
+                        self.pruned_descriptors)
+            finally:
+                os.remove(signame)
+        except Exception as exc:
+            print(exc)
+        finally:
+            self.extractor_slots.release()
+            self.queue.put((LOADED, filename))
+
+    def usable(self, content_hash):
+        """Check whether cached results can be added to the dataset.
+
+        The cache is shared between backends, and results missing
+        descriptors this backend keeps are analyzed again.
+
+        """
+        pruned = self.cache.get_pruned(content_hash)
+        return pruned is not None and set(pruned) <= set(
+            self.pruned_descriptors)
+
+    def _add_point(self, filename):
+        """Add analysis results for an audio file to the dataset."""
+        self.extracting.discard(filename)
+        content_hash = self.cache.get_hash(filename, compute=False)
+        if content_hash is None or not self.add_point(filename, content_hash):
+            self.resolve(filename, False)
+            return
+        self.journal.append(ADD, filename, content_hash)
+        self.resolve(filename, True)
+
+    def _remove_point(self, filename):
+        """Remove a file from the dataset."""
+        print('removing %s' % filename)
+        self.cache.forget_path(filename)
+        if self.remove_point(filename):
+            self.journal.append(REMOVE, filename)
+
+    def replay_journal(self):
+        """Apply the changes made since the dataset was last saved."""
+        entries = self.journal.entries()
+        for entry in entries:
+            command, filename = entry[:2]
+            contained = self.contains(filename)
+            if command == ADD and not contained:
+                self.add_point(filename, entry[2])
+            elif command == REMOVE and contained:
+                self.remove_point(filename)
+        if entries:
+            print("replayed %d journaled changes" % len(entries))
+            self.journal.changed(len(entries))
+
+    def load_descriptors(self, signame):
+        """Load flat descriptors from an extractor JSON file.
+
+        Descriptors in pruned_descriptors are dropped as soon as the object
+        holding them is parsed, and never copied, flattened or stored.
+
+        """
+        def hook(pairs):
+            return prune_descriptors(pairs, self.pruned_descriptors)
+
+        with open(signame, 'r') as sig:
+            return flatten_descriptors(json.load(sig, object_pairs_hook=hook))
+
+    def essentia_analyze(self, filename, signame):
+        """Perform essentia analysis of an audio file."""
+        command = [self.extractor_path, filename, signame]
+        if self.niceness is not None and which('nice'):
+            command = ['nice', '-n', str(self.niceness)] + command
+        if self.io_class is not None and which('ionice'):
+            command = ['ionice', '-c', str(self.io_class)] + command
+        try:
+            subprocess.check_call(command)
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    def compact(self):
+        """Save the dataset and start a new journal.
+
+        This runs on the analysis thread, which handles no other commands
+        until the dataset is written.
+
+        """
+        self.save()
+        self.journal.clear()
+
+    def persist(self):
+        """Make the changes durable, saving the dataset when due."""
+        if not self.transformed or self.journal.is_due(
+                self.compact_changes, self.compact_interval):
+            self.compact()
+        else:
+            self.journal.sync()
+
+    def run(self):
+        """Run main loop for acoustic analysis thread."""
+        try:
+            self.initialize()
+        finally:
+            self.ready.set()
+        print("STARTING ACOUSTIC ANALYSIS THREAD")
+        while True:
+            try:
+                cmd, filename = self.queue.get(
+                    timeout=self.compact_interval if self.journal.changes
+                    else None)
+            except Empty:
+                self.persist()
+                continue
+            while filename:
+                self.commands[cmd](filename)
+                try:
+                    cmd, filename = self.queue.get(block=False)
+                except Empty:
+                    if self.extracting:
+                        # Wait for the extractors to finish.
+                        cmd, filename = self.queue.get()
+                        continue
+                    self.persist()
+                    break
+            print("songs in db after processing queue: %d" % self.size())
+
+    def get_clusterer(self, filenames):
+        """Get a Clusterer that has ordered the analyzed files among
+        filenames, or None when there are fewer than two of them."""
+        analyzed = []
+        seen = set()
+        for filename in filenames:
+            if self.contains(filename) and filename not in seen:
+                seen.add(filename)
+                analyzed.append(filename)
+        if len(analyzed) < 2:
+            return None
+        clusterer = Clusterer(analyzed, self.get_distance_matrix(analyzed))
+        clusterer.cluster()
+        return clusterer
+
+    def get_tracks(self, filename, number, requests=()):
+        """Get most similar tracks from the dataset."""
+        self.ready.wait()
+        if not self.contains_or_add(filename, NOW_PLAYING):
+            return []
+        requests = [
+            request for request in requests
+            if self.contains_or_add(request, REQUESTED)]
+        neighbours = self.get_neighbours(filename, number, requests=requests)
+        print("total found %d" % len(neighbours))
+        if neighbours:
+            print(neighbours[0][0], neighbours[-1][0])
+        return neighbours
+
+    def contains_or_add(self, filename, priority=BULK):
+        """Check if the filename exists in the database, queue it up if not.
+
+        """
+        if not self.contains(filename):
+            print("%s not found in db" % filename)
+            self.queue.put((ADD, filename, priority))
+            return False
+
+        return True
+
+
+class GaiaAnalysis(AcousticAnalysis):
+
+    """Acoustic analysis and comparison with a gaia dataset."""
+
+    def __init__(self, *args, **kwargs):
+        super(GaiaAnalysis, self).__init__(*args, **kwargs)
+        self.gaia_db = None
         self.metric = None
+        self.point_layouts = {}
+        self.view = None
+        self.view_lock = Lock()
 
     def initialize(self):
         """Handle more expensive initialization."""
-        self.gaia_db = self.initialize_gaia_db()
+        super(GaiaAnalysis, self).initialize()
         try:
             self.metric = DistanceFunctionFactory.create(
                 'euclidean', self.gaia_db.layout())
@@ -103,16 +1094,15 @@ class GaiaAnalysis(Thread):
             self.metric = DistanceFunctionFactory.create(
                 'euclidean', self.gaia_db.layout())
             self.transformed = True
+            if self.journal.changes:
+                self.compact()
 
-    def initialize_gaia_db(self):
+    def load(self):
         """Load or initialize the gaia database."""
-        if not os.path.isfile(self.gaia_db_path):
-            dataset = DataSet()
-        else:
-            dataset = self.load_gaia_db()
+        self.gaia_db = DataSet()
+        if os.path.isfile(self.db_path):
+            self.gaia_db.load(self.db_path)
             self.transformed = True
-        print("songs in db: %d" % dataset.size())
-        return dataset
 
     @staticmethod
     def transform(dataset):
@@ -130,191 +1120,932 @@ class GaiaAnalysis(Thread):
         dataset = transform(dataset, 'normalize')
         dataset = transform(
             dataset, 'pca', {
-                'dimension': 30,
+                'dimension': PCA_DIMENSION,
                 'descriptorNames': ['*'],
-                'resultName': 'pca30'})
-        return dataset
-
-    def load_gaia_db(self):
-        """Load the gaia database from disk."""
-        dataset = DataSet()
-        dataset.load(self.gaia_db_path)
+                'resultName': 'pca%d' % PCA_DIMENSION})
         return dataset
 
-    def _analyze(self, filename):
-        """Analyze an audio file."""
-        encoded = filename.encode('utf-8')
-        if self.gaia_db.contains(encoded):
-            return
-        signame = self.get_signame(encoded)
-        if not (os.path.exists(signame) or
-                self.essentia_analyze(encoded, signame)):
-                return
+    def save(self):
+        """Transform dataset if needed and save to disk."""
+        if not self.transformed:
+            self.gaia_db = self.transform(self.gaia_db)
+            self.metric = DistanceFunctionFactory.create(
+                'euclidean', self.gaia_db.layout())
+            self.transformed = True
+            self.invalidate_view()
+        temporary = self.db_path + '.tmp'
+        self.gaia_db.save(temporary)
+        os.rename(temporary, self.db_path)
+
+    def size(self):
+        """Get the number of files in the dataset."""
+        return self.gaia_db.size()
+
+    def contains(self, filename):
+        """Check whether a file is in the dataset."""
+        return self.gaia_db.contains(filename.encode('utf-8'))
+
+    def add_point(self, filename, content_hash):
+        """Add the cached analysis results for a content hash."""
+        descriptors = self.cache.get(content_hash)
+        if descriptors is None:
+            return False
         try:
-            point = self.load_point(signame)
-            point.setName(encoded)
+            point = self.point_from_descriptors({
+                name: value for name, value in descriptors.items()
+                if not any(
+                    pruned in name for pruned in self.pruned_descriptors)})
+            point.setName(filename.encode('utf-8'))
             self.gaia_db.addPoint(point)
-            os.remove(signame)
         except Exception as exc:
             print(exc)
+            return False
+        self.invalidate_view()
+        return True
 
-    def _remove_point(self, filename):
+    def remove_point(self, filename):
         """Remove a point from the gaia database."""
-        encoded = filename.encode('utf-8')
-        print('removing %s' % encoded)
         try:
-            self.gaia_db.removePoint(encoded)
-            signame = self.get_signame(encoded)
-            os.remove(signame)
+            self.gaia_db.removePoint(filename.encode('utf-8'))
         except Exception as exc:
             print(exc)
+            return False
+        self.invalidate_view()
+        return True
 
-    @staticmethod
-    def load_point(signame):
-        """Load point data from JSON file."""
+    def get_point_layout(self, descriptors):
+        """Get the (shared) gaia layout for a set of flat descriptors."""
+        key = tuple(sorted(
+            (name, get_shape(value) is None)
+            for name, value in descriptors.items()))
+        layout = self.point_layouts.get(key)
+        if layout is None:
+            layout = PointLayout()
+            for name, is_label in key:
+                layout.add(name, StringType if is_label else RealType)
+            self.point_layouts[key] = layout
+        return layout
+
+    def point_from_descriptors(self, descriptors):
+        """Build a gaia point directly from flat descriptors."""
         point = Point()
-        with open(signame, 'r') as sig:
-            jsonsig = json.load(sig)
-            if jsonsig.get('metadata', {}).get('tags'):
-                del jsonsig['metadata']['tags']
-            yamlsig = yaml.dump(jsonsig)
-        point.loadFromString(yamlsig)
+        point.setLayout(self.get_point_layout(descriptors))
+        for name, value in descriptors.items():
+            shape = get_shape(value)
+            if shape is None:
+                point.setLabel(name, value)
+            elif len(shape) == 2:
+                point.setValue(name, [v for row in value for v in row])
+            else:
+                point.setValue(name, value)
         return point
 
-    @staticmethod
-    def get_signame(full_path):
-        """Get the path for the analysis data file for this filename."""
-        filename = os.path.split(full_path)[-1]
-        return os.path.join('/tmp', filename + '.sig')
+    def get_distance_matrix(self, filenames):
+        """Get the distances between files in the transformed dataset.
 
-    @staticmethod
-    def essentia_analyze(filename, signame):
-        """Perform essentia analysis of an audio file."""
+        Until the dataset is transformed, a dataset of just the files is.
+
+        """
+        encoded = [filename.encode('utf-8') for filename in filenames]
+        dataset = self.gaia_db
+        if not self.transformed:
+            dataset = DataSet()
+            for filename in encoded:
+                dataset.addPoint(self.gaia_db.point(filename))
+            dataset = self.transform(dataset)
+        if NUMPY:
+            return self.selection_distances(
+                filenames, filenames, self.get_projected(encoded, dataset))
+        points = [dataset.point(filename) for filename in encoded]
+        return [
+            [self.metric(point1, point2) for point2 in points]
+            for point1 in points]
+
+    def get_view(self):
+        """Get the view for nearest neighbour searches in the dataset."""
+        with self.view_lock:
+            if self.view is None:
+                self.view = View(self.gaia_db)
+            return self.view
+
+    def invalidate_view(self):
+        """Forget the view after the dataset changed."""
+        with self.view_lock:
+            self.view = None
+
+    def get_neighbours(self, filename, number, requests=()):
+        """Get a number of nearest neighbours."""
+        result = self.search(self.get_view(), filename.encode('utf-8'), number)
+        if not requests or not result:
+            return result
+        names = [name for _, name in result]
+        scores = self.get_request_distances(
+            names, [request.encode('utf-8') for request in requests])
+        # Filter out the worst matches for the requested tracks
+        return sorted(zip(scores, names))[:max(1, number // 2)]
+
+    def search(self, view, encoded_filename, number):
+        """Search a view for the nearest neighbours of a file."""
         try:
-            subprocess.check_call([ESSENTIA_EXTRACTOR_PATH, filename, signame])
-            return True
+            total = view.nnSearch(
+                encoded_filename, self.metric).get(number + 1)[1:]
         except Exception as e:
             print(e)
-            return False
+            return []
+        return sorted([(score * 1000, name) for name, score in total])
+
+    def get_request_distances(self, names, encoded_requests):
+        """Score points by their distance to the nearest requested point.
+
+        The euclidean metric of a transformed dataset is the distance
+        between the projected descriptors, so with numpy all distances
+        are computed in one go from those.
+
+        """
+        if NUMPY and self.transformed:
+            distances = nearest_distances(
+                self.get_projected(names),
+                self.get_projected(encoded_requests))
+            return (distances * 1000).tolist()
+        request_points = [
+            self.gaia_db.point(request) for request in encoded_requests]
+        scores = []
+        for name in names:
+            point = self.gaia_db.point(name)
+            scores.append(min(
+                self.metric(request_point, point)
+                for request_point in request_points) * 1000)
+        return scores
+
+    def get_projected(self, encoded_filenames, dataset=None):
+        """Get the projected descriptors of points as a matrix."""
+        if dataset is None:
+            dataset = self.gaia_db
+        descriptor = 'pca%d' % PCA_DIMENSION
+        return np.array([
+            dataset.point(name).value(descriptor)
+            for name in encoded_filenames], dtype=np.float32)
+
+
+def common_features(layouts):
+    """Get the real valued descriptors all layouts have in the same size.
+
+    Returns sorted (name, size) pairs.
+
+    """
+    sizes = None
+    for layout in layouts:
+        current = {
+            name: int(np.prod(shape)) for name, shape in layout
+            if shape is not None}
+        if sizes is None:
+            sizes = current
+        else:
+            sizes = {
+                name: size for name, size in sizes.items()
+                if current.get(name) == size}
+    return sorted((sizes or {}).items())
+
+
+def feature_index(layout, features):
+    """Get the positions of features in vectors packed with a layout.
+
+    Returns None if the layout lacks any of the features.
+
+    """
+    positions = {}
+    offset = 0
+    for name, shape in layout:
+        if shape is None:
+            continue
+        size = int(np.prod(shape))
+        positions[name] = (offset, size)
+        offset += size
+    index = []
+    for name, size in features:
+        start, found = positions.get(name, (0, None))
+        if found != size:
+            return None
+        index.extend(range(start, start + size))
+    return np.array(index, dtype=np.intp)
+
+
+class Projection(object):
+
+    """Normalization and principal component analysis, as gaia does them.
+
+    Features that are constant or not finite are left out, the others are
+    scaled to [0, 1] and projected on their principal components.
+
+    """
+
+    def __init__(self, columns, minimum, scale, mean, components):
+        self.columns = columns
+        self.minimum = minimum
+        self.scale = scale
+        self.mean = mean
+        self.components = components
+
+    @property
+    def dimension(self):
+        """Number of dimensions projected to."""
+        return self.components.shape[1]
+
+    @classmethod
+    def fit(cls, chunks, dimension=PCA_DIMENSION):
+        """Fit to feature vectors.
+
+        Since the vectors need not fit in memory, chunks is a function that
+        returns an iterator over matrices holding them. It is called twice.
+        Returns None if there is too little data to fit to.
+
+        """
+        count = 0
+        minimum = maximum = finite = None
+        for features in chunks():
+            count += len(features)
+            valid = np.isfinite(features)
+            features = np.where(valid, features, 0)
+            if finite is None:
+                finite = valid.all(0)
+                minimum = features.min(0)
+                maximum = features.max(0)
+            else:
+                finite &= valid.all(0)
+                minimum = np.minimum(minimum, features.min(0))
+                maximum = np.maximum(maximum, features.max(0))
+        if count < 2:
+            return None
+        columns = np.flatnonzero(finite & (maximum > minimum))
+        if not len(columns):
+            return None
+        minimum = minimum[columns]
+        scale = 1 / (maximum[columns] - minimum)
+        total = np.zeros(len(columns))
+        products = np.zeros((len(columns), len(columns)))
+        for features in chunks():
+            normalized = (features[:, columns] - minimum) * scale
+            total += normalized.sum(0)
+            products += normalized.T.dot(normalized)
+        mean = total / count
+        covariance = products / count - np.outer(mean, mean)
+        _, vectors = np.linalg.eigh(covariance)
+        components = vectors[:, ::-1][:, :dimension]
+        return cls(columns, minimum, scale, mean, components)
+
+    def apply(self, features):
+        """Project a matrix of feature vectors."""
+        normalized = (features[:, self.columns] - self.minimum) * self.scale
+        return (normalized - self.mean).dot(self.components).astype(
+            np.float32)
+
+    def to_arrays(self):
+        """Get the projection as a dict of arrays."""
+        return {
+            'columns': self.columns, 'minimum': self.minimum,
+            'scale': self.scale, 'mean': self.mean,
+            'components': self.components}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Inverse of to_arrays."""
+        return cls(
+            arrays['columns'], arrays['minimum'], arrays['scale'],
+            arrays['mean'], arrays['components'])
+
+
+def standardize(vectors):
+    """Scale vectors to zero mean and unit variance in every dimension."""
+    vectors = vectors - vectors.mean(axis=0)
+    deviations = vectors.std(axis=0)
+    deviations[deviations == 0] = 1
+    return vectors / deviations
+
+
+def pairwise_distances(vectors):
+    """Get the float32 matrix of euclidean distances between vectors."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.einsum('ij,ij->i', vectors, vectors)
+    distances = vectors.dot(vectors.T)
+    distances *= -2
+    distances += norms[:, np.newaxis]
+    distances += norms
+    np.maximum(distances, 0, out=distances)
+    np.sqrt(distances, out=distances)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def edge_lengths(distances, path):
+    """Get the distances between consecutive songs on a path."""
+    return distances[path[:-1], path[1:]].astype(np.float64)
+
+
+def two_opt_pass(distances, path, deadline, tolerance, fixed=0):
+    """Reverse stretches of a path of indices wherever that shortens it.
+
+    The first fixed indices stay where they are. Returns the new path and
+    whether it changed.
+
+    """
+    size = len(path)
+    lengths = edge_lengths(distances, path)
+    improved = False
+    if not fixed:
+        # Reversing the start of the path only changes the edge after it.
+        gains = distances[path[0], path[1:]] - lengths
+        end = int(np.argmin(gains))
+        if gains[end] < -tolerance:
+            path[:end + 1] = path[end::-1].copy()
+            lengths = edge_lengths(distances, path)
+            improved = True
+    for start in range(max(fixed - 1, 0), size - 2):
+        if time() > deadline:
+            break
+        before, after = path[start], path[start + 1]
+        # Gains of reversing path[start + 1:end + 1], the last one for
+        # reversing all of the rest of the path.
+        gains = np.append(
+            distances[before, path[start + 1:-1]] +
+            distances[after, path[start + 2:]] - lengths[start + 1:],
+            distances[before, path[-1]]) - lengths[start]
+        end = start + 1 + int(np.argmin(gains))
+        if gains[end - start - 1] < -tolerance:
+            path[start + 1:end + 1] = path[end:start:-1].copy()
+            lengths = edge_lengths(distances, path)
+            improved = True
+    return path, improved
+
+
+def or_opt_pass(distances, path, deadline, tolerance, fixed=0, longest=3):
+    """Move runs of up to longest songs on a path of indices, possibly
+    reversed, wherever that shortens it.
+
+    The first fixed indices stay where they are. Returns the new path and
+    whether it changed.
+
+    """
+    size = len(path)
+    lengths = edge_lengths(distances, path)
+    improved = False
+    for run in range(1, longest + 1):
+        for start in range(fixed, size - run + 1):
+            if time() > deadline:
+                return path, improved
+            stop = start + run
+            first, last = path[start], path[stop - 1]
+            removed = 0.0
+            if start:
+                removed -= lengths[start - 1]
+            if stop < size:
+                removed -= lengths[stop - 1]
+            if start and stop < size:
+                removed += distances[path[start - 1], path[stop]]
+            # Gains of putting the run in between two songs that are next
+            # to each other, forward and reversed, and at the start or end
+            # of the rest of the path, forward and reversed.
+            forward = (
+                distances[first, path[:-1]] + distances[last, path[1:]] -
+                lengths)
+            backward = (
+                distances[last, path[:-1]] + distances[first, path[1:]] -
+                lengths)
+            forward[max(start - 1, 0):stop] = np.inf
+            backward[max(start - 1, 0):stop] = np.inf
+            forward[:max(fixed - 1, 0)] = np.inf
+            backward[:max(fixed - 1, 0)] = np.inf
+            ends = [np.inf] * 4
+            if start and not fixed:
+                ends[:2] = distances[last, path[0]], distances[first, path[0]]
+            if stop < size:
+                ends[2:] = (
+                    distances[path[-1], first], distances[path[-1], last])
+            gains = np.concatenate((forward, backward, ends))
+            best = int(np.argmin(gains))
+            if removed + gains[best] >= -tolerance:
+                continue
+            moved = path[start:stop]
+            rest = np.concatenate((path[:start], path[stop:]))
+            edges = size - 1
+            if best < 2 * edges:
+                edge = best % edges
+                position = edge + 1 if edge < start else edge - run + 1
+                reverse = best >= edges
+            else:
+                position = 0 if best - 2 * edges < 2 else len(rest)
+                reverse = best % 2 == 1
+            if reverse:
+                moved = moved[::-1]
+            path = np.concatenate((rest[:position], moved, rest[position:]))
+            lengths = edge_lengths(distances, path)
+            improved = True
+    return path, improved
+
+
+def nearest_distances(vectors, targets):
+    """Get the euclidean distance from each vector to the nearest target."""
+    squared = (
+        np.einsum('ij,ij->i', vectors, vectors)[:, np.newaxis] -
+        2 * vectors.dot(targets.T) +
+        np.einsum('ij,ij->i', targets, targets))
+    return np.sqrt(np.maximum(squared.min(axis=1), 0))
+
+
+class EmbeddingStore(object):
+
+    """Vectors in a contiguous float32 matrix, with a name to row index.
+
+    Removing a vector moves the last one into its row, so that the first
+    len(store) rows are always the ones in use.
+
+    """
+
+    def __init__(self, dimension, capacity=1024):
+        self.matrix = np.zeros((max(1, capacity), dimension), dtype=np.float32)
+        self.norms = np.zeros(len(self.matrix), dtype=np.float32)
+        self.names = []
+        self.rows = {}
+
+    @classmethod
+    def from_arrays(cls, names, vectors):
+        """Build a store holding vectors[i] for every names[i]."""
+        store = cls(vectors.shape[1], len(names))
+        store.matrix[:len(names)] = vectors
+        store.norms[:len(names)] = np.einsum('ij,ij->i', vectors, vectors)
+        store.names = list(names)
+        store.rows = {name: row for row, name in enumerate(store.names)}
+        return store
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def add(self, name, vector):
+        """Add or replace the vector for a name."""
+        row = self.rows.get(name)
+        if row is None:
+            row = len(self.names)
+            if row == len(self.matrix):
+                self.grow()
+            self.rows[name] = row
+            self.names.append(name)
+        self.matrix[row] = vector
+        self.norms[row] = self.matrix[row].dot(self.matrix[row])
+
+    def grow(self):
+        """Double the capacity."""
+        capacity = 2 * len(self.matrix)
+        matrix = np.zeros((capacity, self.matrix.shape[1]), dtype=np.float32)
+        matrix[:len(self.matrix)] = self.matrix
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[:len(self.norms)] = self.norms
+        self.matrix = matrix
+        self.norms = norms
+
+    def remove(self, name):
+        """Remove the vector for a name."""
+        row = self.rows.pop(name)
+        last = len(self.names) - 1
+        moved = self.names.pop()
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.norms[row] = self.norms[last]
+            self.names[row] = moved
+            self.rows[moved] = row
+
+    def get_vector(self, name):
+        """Get the vector for a name."""
+        return self.matrix[self.rows[name]]
+
+    def get_vectors(self, names=None):
+        """Get the matrix of all vectors in the order of self.names, or of
+        the vectors for some names."""
+        if names is None:
+            return self.matrix[:len(self.names)]
+        return self.matrix[[self.rows[name] for name in names]]
+
+    def get_distances(self, vector, names=None):
+        """Get euclidean distances from a vector to all or some vectors."""
+        if names is None:
+            rows = slice(0, len(self.names))
+        else:
+            rows = [self.rows[name] for name in names]
+        squared = (
+            self.norms[rows] - 2 * self.matrix[rows].dot(vector) +
+            vector.dot(vector))
+        return np.sqrt(np.maximum(squared, 0))
+
+    def nearest(self, vector, number, exclude=None):
+        """Get (distance, name) tuples for the vectors nearest to vector."""
+        distances = self.get_distances(vector)
+        count = min(number + (exclude is not None), len(distances))
+        if count <= 0:
+            return []
+        if count < len(distances):
+            rows = np.argpartition(distances, count - 1)[:count]
+        else:
+            rows = np.arange(len(distances))
+        rows = rows[np.argsort(distances[rows], kind='stable')]
+        return [
+            (float(distances[row]), self.names[row]) for row in rows
+            if self.names[row] != exclude][:number]
+
 
-    def transform_and_save(self, dataset, path):
-        """Transform dataset and save to disk."""
-        if not self.transformed:
-            dataset = self.transform(dataset)
-            self.metric = DistanceFunctionFactory.create(
-                'euclidean', dataset.layout())
-            self.transformed = True
-        dataset.save(path)
-        return dataset
+class AnnIndex(object):
 
-    def run(self):
-        """Run main loop for gaia analysis thread."""
-        self.initialize()
-        print("STARTING GAIA ANALYSIS THREAD")
-        while True:
-            cmd, filename = self.queue.get()
-            while filename:
-                self.commands[cmd](filename)
-                try:
-                    cmd, filename = self.queue.get(block=False)
-                except Empty:
-                    self.gaia_db = self.transform_and_save(
-                        self.gaia_db, self.gaia_db_path)
-                    break
-            print (
-                "songs in db after processing queue: %d" %
-                self.gaia_db.size())
+    """Approximate nearest neighbour (HNSW) index over named vectors.
 
-    def get_miximized_tracks(self, filenames):
-        """Get list of tracks in ideal order."""
-        for filename in filenames:
-            self.queue.put((ADD, filename))
-        while self.queue.qsize():
-            print("waiting for analysis")
-            sleep(10)
-        encoded = [f.encode('utf-8') for f in filenames]
-        dataset = DataSet()
-        number_of_tracks = len(filenames)
-        for filename in encoded:
-            if not self.gaia_db.contains(filename):
-                continue
-            point = self.gaia_db.point(filename)
-            dataset.addPoint(point)
-        dataset = self.transform(dataset)
-        matrix = {}
-        for filename in encoded:
-            matrix[filename] = {
-                name: score for score, name in self.get_neighbours(
-                    dataset, filename, number_of_tracks)}
-        clusterer = Clusterer(encoded, lambda f1, f2: matrix[f1][f2])
-        clusterer.cluster()
-        result = []
-        for cluster in clusterer.clusters:
-            result.extend([encoded.index(filename) for filename in cluster])
-        return result
+    hnswlib only knows integer labels, so every vector added gets a new
+    label. Removed vectors are marked deleted, and their slots reused by
+    later additions.
 
-    def get_tracks(self, filename, number, request=None):
-        """Get most similar tracks from the gaia database."""
-        while self.gaia_db is None:
-            sleep(.1)
-        encoded = filename.encode('utf-8')
-        if not self.contains_or_add(encoded):
-            return []
-        encoded_request = None
-        if request:
-            encoded_request = request.encode('utf-8')
-            if not self.contains_or_add(encoded_request):
-                encoded_request = None
-        neighbours = self.get_neighbours(
-            self.gaia_db, encoded, number, encoded_request=encoded_request)
-        print("total found %d" % len(neighbours))
-        print(neighbours[0][0], neighbours[-1][0])
-        return neighbours
+    """
 
-    def get_neighbours(self, dataset, encoded_filename, number,
-                       encoded_request=None):
-        """Get a number of nearest neighbours."""
-        view = View(dataset)
-        request_point = self.gaia_db.point(
-            encoded_request) if encoded_request else None
-        try:
-            total = view.nnSearch(
-                encoded_filename, self.metric).get(number + 1)[1:]
-        except Exception as e:
-            print(e)
+    def __init__(self, dimension, capacity=1024, ef=ANN_EF):
+        self.dimension = dimension
+        self.index = hnswlib.Index(space='l2', dim=dimension)
+        self.index.init_index(
+            max_elements=max(1, capacity), ef_construction=ANN_EF_CONSTRUCTION,
+            M=ANN_M, allow_replace_deleted=True)
+        self.index.set_ef(ef)
+        self.labels = {}
+        self.names = {}
+        self.next_label = 0
+
+    @classmethod
+    def from_store(cls, store, ef=ANN_EF):
+        """Index all vectors in an EmbeddingStore."""
+        ann = cls(store.matrix.shape[1], len(store), ef)
+        if len(store):
+            ann.index.add_items(store.get_vectors(), np.arange(len(store)))
+            ann.set_labels(store.names, range(len(store)))
+        return ann
+
+    @classmethod
+    def load(cls, path, dimension, names, labels, ef=ANN_EF):
+        """Load an index saved for names with their labels."""
+        ann = cls.__new__(cls)
+        ann.dimension = dimension
+        ann.index = hnswlib.Index(space='l2', dim=dimension)
+        ann.index.load_index(path, allow_replace_deleted=True)
+        ann.index.set_ef(ef)
+        ann.set_labels(names, labels)
+        return ann
+
+    def set_labels(self, names, labels):
+        """Set the labels of the indexed vectors."""
+        self.labels = {name: int(label) for name, label in zip(names, labels)}
+        self.names = {label: name for name, label in self.labels.items()}
+        self.next_label = max(self.names) + 1 if self.names else 0
+
+    def save(self, path):
+        """Save the index; the labels are for the caller to save."""
+        temporary = path + '.tmp'
+        self.index.save_index(temporary)
+        os.rename(temporary, path)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def set_ef(self, ef):
+        """Set the recall/speed trade off for searches."""
+        self.index.set_ef(ef)
+
+    def add(self, name, vector):
+        """Add or replace the vector for a name."""
+        if name in self.labels:
+            self.remove(name)
+        if len(self.labels) >= self.index.get_max_elements():
+            self.index.resize_index(2 * self.index.get_max_elements())
+        label = self.next_label
+        self.next_label += 1
+        self.index.add_items(
+            vector[np.newaxis], [label], replace_deleted=True)
+        self.labels[name] = label
+        self.names[label] = name
+
+    def remove(self, name):
+        """Remove the vector for a name."""
+        label = self.labels.pop(name)
+        del self.names[label]
+        self.index.mark_deleted(label)
+
+    def nearest(self, vector, number, exclude=None):
+        """Get (distance, name) tuples for the vectors nearest to vector.
+
+        Raises RuntimeError when the index finds too few vectors.
+
+        """
+        count = min(number + (exclude is not None), len(self.labels))
+        if count <= 0:
             return []
+        labels, distances = self.index.knn_query(vector[np.newaxis], k=count)
+        return [
+            (float(np.sqrt(distance)), self.names[label])
+            for label, distance in zip(labels[0].tolist(), distances[0])
+            if self.names[label] != exclude][:number]
+
+
+def benchmark_ann(store, number=10, queries=1000,
+                  efs=(10, 20, 50, 100, 200, 400)):
+    """Report recall@number and speed of the ANN index vs exact search."""
+    start = time()
+    ann = AnnIndex.from_store(store)
+    print("indexed %d vectors in %.1fs" % (len(store), time() - start))
+    names = [
+        store.names[row] for row in np.random.choice(
+            len(store), min(queries, len(store)), replace=False)]
+    start = time()
+    exact = {
+        name: set(
+            found for _, found in store.nearest(
+                store.get_vector(name), number, exclude=name))
+        for name in names}
+    print("exact: %.3fms per query" % (
+        (time() - start) * 1000 / len(names)))
+    for ef in efs:
+        ann.set_ef(max(ef, number + 1))
+        start = time()
+        approximate = {
+            name: set(
+                found for _, found in ann.nearest(
+                    store.get_vector(name), number, exclude=name))
+            for name in names}
+        elapsed = time() - start
+        recall = sum(
+            len(approximate[name] & exact[name]) / max(1, len(exact[name]))
+            for name in names) / len(names)
+        print("ef %4d: recall@%d %.4f, %.3fms per query" % (
+            ef, number, recall, elapsed * 1000 / len(names)))
+
+
+class NumpyAnalysis(AcousticAnalysis):
+
+    """Acoustic analysis and comparison with NumPy.
+
+    Analysis results are normalized and projected like gaia does, and the
+    projected vectors kept in an EmbeddingStore, so this works without
+    gaia. The projection is fitted again whenever the number of files has
+    doubled since the last fit. If hnswlib is installed, the vectors are
+    also kept in an AnnIndex, saved next to the dataset, which large
+    datasets are searched with.
 
-        result = sorted([
-            (self.compute_score(
-                score, name, request_point=request_point) * 1000,
-             name)
-            for name, score in total])
-        if request_point:
-            # Filter out the worst matches for the requested track
-            return result[:max(1, number / 2)]
-        return result
+    """
 
-    def compute_score(self, score, name, request_point=None):
-        """If there is a request, score by distance to that instead."""
-        if request_point is None:
-            return score
-        return self.metric(request_point, self.gaia_db.point(name))
+    pruned_descriptors = PRUNED_DESCRIPTORS
+
+    def __init__(self, *args, **kwargs):
+        self.ann_ef = kwargs.pop('ann_ef', ANN_EF)
+        super(NumpyAnalysis, self).__init__(*args, **kwargs)
+        self.ann_path = os.path.splitext(self.db_path)[0] + '.hnsw'
+        self.ann = None
+        self.hashes = {}
+        self.features = []
+        self.indices = {}
+        self.projection = None
+        self.fitted_size = 0
+        self.store = None
+        self.lock = Lock()
+
+    def load(self):
+        """Load the saved vectors, if any."""
+        if not os.path.isfile(self.db_path):
+            return
+        with np.load(self.db_path) as saved:
+            names = saved['names'].tolist()
+            self.hashes = dict(zip(names, saved['hashes'].tolist()))
+            if 'components' not in saved.files:
+                return
+            self.features = [
+                tuple(feature) for feature in json.loads(
+                    str(saved['features']))]
+            self.projection = Projection.from_arrays(saved)
+            self.fitted_size = int(saved['fitted_size'])
+            self.store = EmbeddingStore.from_arrays(names, saved['vectors'])
+            if HNSW:
+                self.ann = self.load_ann(saved)
+        self.transformed = True
+
+    def load_ann(self, saved):
+        """Load the saved index, or index the vectors again."""
+        if ('ann_labels' in saved.files and os.path.isfile(self.ann_path) and
+                os.path.getsize(self.ann_path) == int(saved['ann_size'])):
+            try:
+                return AnnIndex.load(
+                    self.ann_path, self.projection.dimension,
+                    self.store.names, saved['ann_labels'], self.ann_ef)
+            except Exception as e:
+                print(e)
+        return AnnIndex.from_store(self.store, self.ann_ef)
+
+    def save(self):
+        """Fit the projection if due, and save the vectors."""
+        if len(self.hashes) >= REFIT_GROWTH * self.fitted_size:
+            self.fit()
+        arrays = {}
+        if self.store is None:
+            names = list(self.hashes)
+        else:
+            names = self.store.names
+            arrays = self.projection.to_arrays()
+            arrays.update(
+                vectors=self.store.get_vectors(),
+                features=np.array(json.dumps(self.features)),
+                fitted_size=np.array(self.fitted_size))
+            if self.ann is not None:
+                # Saved first, with its size recorded, so a crash between
+                # the two saves is noticed when loading.
+                self.ann.save(self.ann_path)
+                arrays.update(
+                    ann_labels=np.array(
+                        [self.ann.labels[name] for name in names],
+                        dtype=np.int64),
+                    ann_size=np.array(os.path.getsize(self.ann_path)))
+        temporary = self.db_path + '.tmp'
+        with open(temporary, 'wb') as saved:
+            np.savez(
+                saved, names=np.array(names, dtype=str),
+                hashes=np.array([self.hashes[name] for name in names],
+                                dtype=str), **arrays)
+        os.rename(temporary, self.db_path)
+
+    def fit(self):
+        """Fit the projection to all files, and project them."""
+        items = list(self.hashes.items())
+        features, projection = self.fit_projection(items)
+        if projection is None:
+            return
+        indices = {}
+        store = self.project(items, features, projection, indices)
+        ann = AnnIndex.from_store(store, self.ann_ef) if HNSW else None
+        with self.lock:
+            self.features = features
+            self.indices = indices
+            self.projection = projection
+            self.store = store
+            self.ann = ann
+        for name in list(self.hashes):
+            if name not in store:
+                del self.hashes[name]
+        self.fitted_size = len(store)
+        self.transformed = True
+        print("fitted projection to %d songs" % self.fitted_size)
+
+    def fit_projection(self, items):
+        """Fit a projection to the results for (name, content hash) pairs.
+
+        Returns the features used, and the projection, or None if there
+        is too little data.
 
-    def contains_or_add(self, encoded_filename):
-        """Check if the filename exists in the database, queue it up if not.
+        """
+        features = common_features(self.cache.get_layouts(
+            [content_hash for _, content_hash in items]))
+        return features, Projection.fit(lambda: (
+            matrix for _, matrix in self.iter_features(items, features, {})))
+
+    def project(self, items, features, projection, indices):
+        """Project the results for (name, content hash) pairs to a store."""
+        store = EmbeddingStore(projection.dimension, len(items))
+        for names, matrix in self.iter_features(items, features, indices):
+            for name, vector in zip(names, projection.apply(matrix)):
+                if np.isfinite(vector).all():
+                    store.add(name, vector)
+        return store
+
+    def iter_features(self, items, features, indices):
+        """Get the feature vectors for (name, content hash) pairs.
+
+        Yields lists of names with a matrix of their feature vectors. Files
+        that lack any of the features are left out. Indices caches the
+        feature positions for every layout.
 
         """
-        if not self.gaia_db.contains(encoded_filename):
-            print("%s not found in gaia db" % encoded_filename)
-            self.queue.put((ADD, str(encoded_filename)))
+        for chunk in chunked(items):
+            packed = self.cache.get_packed(
+                [content_hash for _, content_hash in chunk])
+            names = []
+            rows = []
+            for name, content_hash in chunk:
+                if content_hash not in packed:
+                    continue
+                layout_id, layout, blob = packed[content_hash]
+                if layout_id not in indices:
+                    indices[layout_id] = feature_index(layout, features)
+                index = indices[layout_id]
+                if index is None:
+                    continue
+                names.append(name)
+                rows.append(np.frombuffer(blob, dtype=np.float32)[index])
+            if rows:
+                yield names, np.array(rows, dtype=np.float64)
+
+    def size(self):
+        """Get the number of files in the dataset."""
+        return len(self.hashes)
+
+    def contains(self, filename):
+        """Check whether a file is in the dataset."""
+        return filename in self.hashes
+
+    def add_point(self, filename, content_hash):
+        """Add the cached analysis results for a content hash."""
+        if self.projection is None:
+            if not self.cache.get_packed([content_hash]):
+                return False
+            self.hashes[filename] = content_hash
+            return True
+        for _, matrix in self.iter_features(
+                [(filename, content_hash)], self.features, self.indices):
+            vector = self.projection.apply(matrix)[0]
+            if np.isfinite(vector).all():
+                with self.lock:
+                    self.store.add(filename, vector)
+                    if self.ann is not None:
+                        self.ann.add(filename, vector)
+                self.hashes[filename] = content_hash
+                return True
+        return False
+
+    def remove_point(self, filename):
+        """Remove a file from the dataset."""
+        if self.hashes.pop(filename, None) is None:
             return False
-
+        if self.store is not None:
+            with self.lock:
+                self.store.remove(filename)
+                if self.ann is not None:
+                    self.ann.remove(filename)
         return True
 
+    def get_neighbours(self, filename, number, requests=()):
+        """Get a number of nearest neighbours."""
+        with self.lock:
+            if self.store is None or filename not in self.store:
+                return []
+            vector = self.store.get_vector(filename)
+            neighbours = None
+            if self.ann is not None and len(self.store) >= ANN_MIN_SIZE:
+                try:
+                    neighbours = self.ann.nearest(
+                        vector, number, exclude=filename)
+                except RuntimeError as e:
+                    print(e)
+            if neighbours is None:
+                neighbours = self.store.nearest(
+                    vector, number, exclude=filename)
+            requests = [
+                request for request in requests if request in self.store]
+            if not requests or not neighbours:
+                return [
+                    (distance * 1000, name) for distance, name in neighbours]
+            names = [name for _, name in neighbours]
+            distances = nearest_distances(
+                self.store.get_vectors(names),
+                self.store.get_vectors(requests))
+        # Filter out the worst matches for the requested tracks
+        return sorted(zip((distances * 1000).tolist(), names))[
+            :max(1, number // 2)]
+
+    def get_distance_matrix(self, filenames):
+        """Get the distances between the projected files.
+
+        Until the first fit, the files are projected on their own. Files
+        that could not be projected are infinitely far from all others.
+
+        """
+        with self.lock:
+            store = self.store
+            if store is not None:
+                names = [
+                    filename for filename in filenames if filename in store]
+                vectors = store.get_vectors(names)
+        if store is not None:
+            return self.selection_distances(filenames, names, vectors)
+        items = [(filename, self.hashes[filename]) for filename in filenames]
+        features, projection = self.fit_projection(items)
+        if projection is None:
+            return self.selection_distances(filenames, [], None)
+        store = self.project(items, features, projection, {})
+        return self.selection_distances(
+            filenames, store.names, store.get_vectors())
+
 
 class DatabaseWrapper(Thread):
 
-    """Process to handle all database access."""
+    """Process to handle all database access.
+
+    Writes are group committed: every write that is pending on the queue is
+    executed in a single transaction, which is committed once the queue is
+    drained, or when `batch_size` writes have been executed or the
+    transaction has been open for `batch_time` seconds, whichever comes
+    first. Results of writes are only handed back after the commit.
+
+    """
+
+    batch_size = 500
+    batch_time = .5
 
     def set_path(self, path):
         """Set the database path."""
@@ -327,144 +2058,490 @@ class DatabaseWrapper(Thread):
     def run(self):
         print("STARTING DATABASE WRAPPER THREAD")
         connection = sqlite3.connect(self.path, isolation_level='immediate')
+        connection.execute('PRAGMA journal_mode=WAL;')
+        connection.execute('PRAGMA synchronous=NORMAL;')
         cursor = connection.cursor()
-        commit_needed = False
-        while True:
+        stop = None
+        while stop is None:
             _, cmd = self.queue.get()
-            sql = cmd.sql
-            if sql == ('STOP',):
-                cmd.result_queue.put(None)
-                connection.close()
-                break
-            result = []
-            commit_needed = False
-            try:
-                cursor.execute(*sql)
-            except Exception as e:
-                print(e, repr(sql))
-            if not sql[0].upper().startswith('SELECT'):
-                commit_needed = True
-            for row in cursor.fetchall():
-                result.append(row)
-            if commit_needed:
+            written = []
+            started = None
+            while True:
+                if cmd.is_stop():
+                    stop = cmd
+                    break
+                result = cmd.execute(cursor)
+                if cmd.is_read():
+                    cmd.result_queue.put(result)
+                else:
+                    if not written:
+                        started = time()
+                    written.append((cmd, result))
+                if written and (
+                        len(written) >= self.batch_size or
+                        time() - started >= self.batch_time):
+                    break
+                try:
+                    _, cmd = self.queue.get(block=False)
+                except Empty:
+                    break
+            if written:
                 connection.commit()
-            cmd.result_queue.put(result)
+            for cmd, result in written:
+                cmd.result_queue.put(result)
+        stop.result_queue.put(None)
+        connection.close()
+
+
+class ReaderPool(object):
 
+    """Pool of read only connections to the similarity database.
 
-class Pair(object):
+    The database is in WAL mode, so readers never wait for the writer
+    thread, and see everything it has committed.
 
-    """A pair of songs."""
+    """
+
+    def __init__(self, path, size=4):
+        self.path = path
+        self.connections = Queue()
+        for _ in range(size):
+            # Connections are opened lazily, once the writer has created
+            # the database.
+            self.connections.put(None)
+
+    def connect(self):
+        """Open a read only connection."""
+        return sqlite3.connect(
+            'file:%s?mode=ro' % pathname2url(self.path), uri=True,
+            check_same_thread=False)
+
+    def execute(self, sql):
+        """Execute a SELECT statement and return the result rows."""
+        connection = self.connections.get()
+        try:
+            if connection is None:
+                connection = self.connect()
+            return connection.execute(*sql).fetchall()
+        except Exception as e:
+            print(e, repr(sql))
+            return []
+        finally:
+            self.connections.put(connection)
 
-    def __init__(self, song1, song2, song_distance):
-        self.song1 = song1
-        self.song2 = song2
-        self.distance = song_distance
 
-    def other(self, song):
-        """Return the song paired with @song."""
-        if self.song1 == song:
-            return self.song2
-        return self.song1
+class IdCache(object):
 
-    def songs(self):
-        """Return both songs."""
-        return [self.song1, self.song2]
+    """Bounded mapping of artist names or tracks to database ids.
 
-    def __eq__(self, other):
-        return self.song1 == other.song1 and self.song2 == other.song2
+    When full, the least recently used entry is dropped.
+
+    """
 
-    def __repr__(self):
-        return '<Pair {song1}, {song2}: {distance}>'.format(
-            song1=self.song1, song2=self.song2, distance=self.distance)
+    def __init__(self, size=ID_CACHE_SIZE):
+        self.size = size
+        self._ids = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Get the id for key, or None if it is not cached."""
+        with self._lock:
+            id_ = self._ids.pop(key, None)
+            if id_ is not None:
+                self._ids[key] = id_
+            return id_
+
+    def set(self, key, id_):
+        """Cache the id for key."""
+        with self._lock:
+            self._ids.pop(key, None)
+            self._ids[key] = id_
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+    def discard(self, key):
+        """Remove key from the cache if present."""
+        with self._lock:
+            self._ids.pop(key, None)
 
 
 class Clusterer(object):
 
-    """Build a list of songs in optimized order."""
+    """Build a list of songs in optimized order.
 
-    def __init__(self, songs, comparison_function):
+    Repeatedly joins the closest two songs that are each on their own or
+    at the end of a path, and not the two ends of the same path, until all
+    songs are on one path. Only the opposite end of every path end and the
+    degree of every song are tracked, and a heap holds the closest
+    joinable song for every song that can still be joined.
+
+    For the same distances, pairs are joined in the same order as by
+    sorting all pairs by distance, ties included. Distances that only
+    differ beyond float32 precision are ties in a float32 matrix, though.
+
+    """
+
+    def __init__(self, songs, distances):
+        """Order songs by distances[i][j] between songs[i] and songs[j]."""
+        self.songs = songs
         self.clusters = []
-        self.ends = []
-        self.similarities = []
-        self.build_similarity_matrix(songs, comparison_function)
-
-    def build_similarity_matrix(self, songs, comparison_function):
-        """Build the similarity matrix."""
-        for song1 in songs:
-            for song2 in songs[songs.index(song1) + 1:]:
-                self.similarities.append(
-                    Pair(song1, song2, comparison_function(song1, song2)))
-        # sort in reverse, since we'll be popping off the end
-        self.similarities.sort(reverse=True, key=lambda x: x.distance)
-
-    def join(self, cluster1, cluster2):
-        """Join two clusters together."""
-        if cluster1[0] == cluster2[0]:
-            cluster2.reverse()
-            self.clean(cluster1[0])
-            return cluster2 + cluster1[1:]
-        elif cluster1[-1] == cluster2[0]:
-            self.clean(cluster1[-1])
-            return cluster1 + cluster2[1:]
-        elif cluster1[0] == cluster2[-1]:
-            self.clean(cluster1[0])
-            return cluster2 + cluster1[1:]
-        cluster2.reverse()
-        self.clean(cluster1[-1])
-        return cluster1[:-1] + cluster2
-
-    def pop_cluster_ending_in(self, song):
-        """Pop a cluster with @song at either end."""
-        for cluster in self.clusters[:]:
-            if cluster[0] == song:
-                self.clusters.remove(cluster)
-                self.ends.remove(cluster[0])
-                self.ends.remove(cluster[-1])
-                return cluster
-            if cluster[-1] == song:
-                self.clusters.remove(cluster)
-                self.ends.remove(cluster[0])
-                self.ends.remove(cluster[-1])
-                return cluster
+        self.distances = np.asarray(distances) if NUMPY else distances
+        self.path = []
+        self.length = 0.0
+        self.degrees = None
+        self.ends = None
+        self.refining = None
+
+    def pair_index(self, index1, index2):
+        """Get the position of a pair in the list of all pairs."""
+        if index1 > index2:
+            index1, index2 = index2, index1
+        return (
+            index1 * len(self.songs) - index1 * (index1 + 1) // 2 + index2 -
+            index1 - 1)
+
+    def closest(self, index):
+        """Get the closest song a song can be joined with.
+
+        Of equally distant songs the last one wins, so that pairs are
+        joined in the same order as by sorting them by distance.
+
+        """
+        row = self.distances[index]
+        if NUMPY:
+            joinable = self.degrees < 2
+            joinable[index] = joinable[self.ends[index]] = False
+            candidates = np.flatnonzero(joinable)
+            if not len(candidates):
+                return None
+            distances = row[candidates]
+            return int(candidates[
+                np.flatnonzero(distances == distances.min())[-1]])
+        closest = None
+        for candidate, degree in enumerate(self.degrees):
+            if degree < 2 and candidate not in (index, self.ends[index]) and (
+                    closest is None or row[candidate] <= row[closest]):
+                closest = candidate
+        return closest
+
+    def push_closest(self, heap, index):
+        """Put the closest song a song can be joined with on the heap."""
+        closest = self.closest(index)
+        if closest is not None:
+            heappush(heap, (
+                float(self.distances[index][closest]),
+                -self.pair_index(index, closest), index, closest))
 
     def cluster(self):
         """Build clusters out of similarity matrix."""
-        sim = self.similarities.pop()
-        self.clusters = [sim.songs()]
-        self.ends = sim.songs()
-        while self.similarities:
-            sim = self.similarities.pop()
-            songs = sim.songs()
-            if sim.song1 in self.ends or sim.song2 in self.ends:
-                cluster1 = self.pop_cluster_ending_in(sim.song1)
-                cluster2 = self.pop_cluster_ending_in(sim.song2)
-                if cluster1 and cluster2:
-                    new_cluster = self.join(cluster1, songs)
-                    new_cluster = self.join(new_cluster, cluster2)
-                elif cluster1:
-                    if sim.song1 in cluster1 and sim.song2 in cluster1:
-                        new_cluster = cluster1
-                    else:
-                        new_cluster = self.join(cluster1, songs)
-                else:
-                    if sim.song1 in cluster2 and sim.song2 in cluster2:
-                        new_cluster = cluster2
-                    else:
-                        new_cluster = self.join(cluster2, songs)
-                self.clusters.append(new_cluster)
-                self.ends.extend([new_cluster[0], new_cluster[-1]])
-            else:
-                self.clusters.append(songs)
-                self.ends.extend(songs)
-
-    def clean(self, found):
-        """Remove similarity scores for processed cluster."""
-        new = []
-        for sim in self.similarities:
-            if found in sim.songs():
+        size = len(self.songs)
+        if size < 2:
+            self.path = list(range(size))
+            self.clusters = [list(self.songs)] if self.songs else []
+            self.length = 0.0
+            return
+        self.degrees = np.zeros(size, dtype=int) if NUMPY else [0] * size
+        self.ends = list(range(size))
+        heads = [False] * size
+        links = [[] for _ in range(size)]
+        heap = []
+        for index in range(size):
+            self.push_closest(heap, index)
+        joined = 0
+        while joined < size - 1:
+            _, _, index, closest = heappop(heap)
+            if self.degrees[index] > 1:
+                continue
+            if self.degrees[closest] > 1 or self.ends[index] == closest:
+                self.push_closest(heap, index)
                 continue
-            new.append(sim)
-        self.similarities = new
+            song1, song2 = sorted((index, closest))
+            end1, end2 = self.ends[song1], self.ends[song2]
+            # The far end of the path song1 is on keeps its place, and the
+            # other far end takes the place of song1.
+            if self.degrees[song1]:
+                head = end1 if heads[end1] else end2
+            elif self.degrees[song2]:
+                head = end2 if heads[end2] else end1
+            else:
+                head = song1
+            heads[end1] = head == end1
+            heads[end2] = head == end2
+            self.ends[end1], self.ends[end2] = end2, end1
+            links[song1].append(song2)
+            links[song2].append(song1)
+            self.degrees[song1] += 1
+            self.degrees[song2] += 1
+            joined += 1
+            if self.degrees[index] < 2:
+                self.push_closest(heap, index)
+        current = next(
+            index for index in range(size)
+            if self.degrees[index] < 2 and heads[index])
+        previous = None
+        self.path = []
+        while current is not None:
+            self.path.append(current)
+            previous, current = current, next(
+                (link for link in links[current] if link != previous), None)
+        self.clusters = [[self.songs[index] for index in self.path]]
+        self.length = self.path_length()
+
+    def path_length(self):
+        """Get the sum of the distances along the path."""
+        if NUMPY:
+            return float(
+                edge_lengths(self.distances, np.array(self.path)).sum())
+        return sum(
+            float(self.distances[index1][index2])
+            for index1, index2 in zip(self.path, self.path[1:]))
+
+    def prepare_refining(self):
+        """Get the distances and tolerance to refine the path with.
+
+        They are worked out once, on the first call, for all refinements.
+
+        """
+        if self.refining is None:
+            distances = self.distances
+            finite = np.isfinite(distances)
+            if not finite.all():
+                # Keep the arithmetic finite, with missing distances still
+                # longer than any other.
+                distances = np.where(
+                    finite, distances, 2 * distances[finite].max() + 1)
+            # Ignore improvements that could be rounding errors.
+            length = float(edge_lengths(distances, np.array(self.path)).sum())
+            self.refining = distances, 1e-4 * length / len(self.path)
+        return self.refining
+
+    def refine(self, time_budget, fixed=0):
+        """Shorten the path by local search for at most time_budget seconds.
+
+        Alternates 2-opt and Or-opt passes until neither improves the path
+        or time runs out, leaving the first fixed songs in place. Needs
+        numpy. Returns the length of the path before and after.
+
+        How much shorter the path gets depends on the data: the greedy path
+        leaves a lot more to gain between points in a few dimensions than
+        between the projected analysis results.
+
+        """
+        before = self.length
+        if not NUMPY or time_budget <= 0 or len(self.path) - fixed < 2:
+            return before, before
+        deadline = time() + time_budget
+        distances, tolerance = self.prepare_refining()
+        path = np.array(self.path)
+        improved = True
+        while improved and time() < deadline:
+            path, improved = two_opt_pass(
+                distances, path, deadline, tolerance, fixed)
+            path, moved = or_opt_pass(
+                distances, path, deadline, tolerance, fixed)
+            improved = improved or moved
+        self.path = path.tolist()
+        self.clusters = [[self.songs[index] for index in self.path]]
+        self.length = self.path_length()
+        return before, self.length
+
+
+class MiximizeJob(object):
+
+    """Order files by acoustic similarity in the background.
+
+    Once the files are analyzed, or after timeout seconds, the analyzed
+    ones are ordered, and the order is handed out in chunks of chunk_size
+    indices into filenames, each as soon as it is final. Files that are not
+    analyzed come last, in their original order. All callbacks get the job
+    id first, and are called from other threads:
+
+    progress(job, stage, done, total) -- files analyzed or ordered so far
+    chunk(job, indices) -- the next part of the order
+    done(job, length_before, length_after) -- the order is complete, and
+        the total distance along it before and after refining it
+    failed(job, message) -- there is no order
+
+    """
+
+    ids = count(1)
+
+    def __init__(self, analyser, filenames, progress, chunk, done, failed,
+                 timeout=MIXIMIZE_TIMEOUT, partial=True, refine_time=0,
+                 chunk_size=MIXIMIZE_CHUNK_SIZE):
+        self.id = next(self.ids)
+        self.analyser = analyser
+        self.filenames = filenames
+        self.progress = progress
+        self.chunk = chunk
+        self.done = done
+        self.failed = failed
+        self.timeout = timeout
+        self.partial = partial
+        self.refine_time = refine_time
+        self.chunk_size = chunk_size
+        self.handles = []
+
+    def start(self):
+        """Queue the files for analysis, and order them when done."""
+        if self.analyser is None:
+            self.failed(self.id, 'Acoustic analysis is not available.')
+            return
+        self.handles = self.analyser.analyze(self.filenames, REQUESTED)
+        total = len(self.handles)
+        step = max(1, total // 100)
+        lock = Lock()
+        analyzed = [0]
+
+        def report(_):
+            with lock:
+                analyzed[0] += 1
+                current = analyzed[0]
+            if current % step == 0 or current == total:
+                self.progress(self.id, ANALYZING, current, total)
+
+        for handle in self.handles:
+            handle.add_done_callback(report)
+        when_done(self.handles, self.analysis_done, self.timeout)
+
+    def analysis_done(self, complete):
+        """Start ordering the files, unless that has to wait for more."""
+        if not (complete or self.partial):
+            self.failed(
+                self.id, 'Timed out waiting for analysis of %d files.' % len([
+                    handle for handle in self.handles
+                    if not handle.done()]))
+            return
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        """Order the files, and hand out the order."""
+        try:
+            self.order()
+        except Exception as e:
+            self.failed(self.id, repr(e))
+
+    def order(self):
+        """Hand out the order of the files chunk by chunk."""
+        positions = {}
+        for index, filename in enumerate(self.filenames):
+            positions.setdefault(filename, index)
+        clusterer = self.analyser.get_clusterer(self.filenames)
+        ordered = set()
+        before = after = 0.0
+        if clusterer is not None:
+            size = len(clusterer.path)
+            chunk_size = self.chunk_size or size
+            # Refine the whole order for half the time before handing out
+            # the first chunk, and the rest of it for the time left after.
+            deadline = time() + self.refine_time
+            before, after = clusterer.refine(
+                self.refine_time / 2.0 if size > chunk_size else
+                self.refine_time)
+            for start in range(0, size, chunk_size):
+                if start == chunk_size:
+                    _, after = clusterer.refine(
+                        deadline - time(), fixed=start)
+                chunk = [
+                    positions[filename] for filename in
+                    clusterer.clusters[0][start:start + chunk_size]]
+                ordered.update(chunk)
+                self.chunk(self.id, chunk)
+                self.progress(self.id, ORDERING, start + len(chunk), size)
+            if self.refine_time:
+                print("refined miximize path from %f to %f" % (
+                    before, after))
+        rest = [
+            index for index in range(len(self.filenames))
+            if index not in ordered]
+        if rest:
+            self.chunk(self.id, rest)
+        self.done(self.id, before, after)
+
+
+class Refresher(Thread):
+
+    """Refresh expired last.fm similarity data while the service is idle.
+
+    Works through the expired tracks and artists, longest expired first,
+    one last.fm call at a time, and only when no interactive lookups have
+    been made for idle_time seconds.
+
+    """
+
+    batch_size = 50
+    idle_time = 10
+    pass_interval = 60 * 60
+
+    def __init__(self, similarity):
+        super(Refresher, self).__init__()
+        self.similarity = similarity
+        self.refreshed = 0
+        self.failed = 0
+        self.paused = False
+
+    def wait_until_idle(self):
+        """Block until the similarity service has been idle for a while."""
+        while not self.similarity.is_idle(self.idle_time):
+            self.paused = True
+            sleep(1)
+        self.paused = False
+
+    def count(self, results):
+        """Keep track of successful and failed refreshes."""
+        if results:
+            self.refreshed += 1
+        else:
+            self.failed += 1
+
+    def refresh_tracks(self):
+        """Refresh all expired tracks."""
+        similarity = self.similarity
+        after = (None, 0)
+        rows = similarity.get_stale_tracks(self.batch_size)
+        while rows:
+            for artist_name, title, track_id, updated in rows:
+                self.wait_until_idle()
+                after = (updated, track_id)
+                if similarity.is_track_fresh(track_id):
+                    continue
+                self.count(similarity.get_similar_tracks_from_lastfm(
+                    artist_name, title, track_id))
+            rows = similarity.get_stale_tracks(self.batch_size, after=after)
+
+    def refresh_artists(self):
+        """Refresh all expired artists."""
+        similarity = self.similarity
+        after = (None, 0)
+        rows = similarity.get_stale_artists(self.batch_size)
+        while rows:
+            for artist_name, artist_id, updated in rows:
+                self.wait_until_idle()
+                after = (updated, artist_id)
+                if similarity.is_artist_fresh(artist_id):
+                    continue
+                self.count(similarity.get_similar_artists_from_lastfm(
+                    artist_name, artist_id))
+            rows = similarity.get_stale_artists(self.batch_size, after=after)
+
+    def get_progress(self):
+        """Report on the refreshing work done and left to do."""
+        stale_artists, stale_tracks = self.similarity.count_stale()
+        return {
+            'refreshed': self.refreshed,
+            'failed': self.failed,
+            'stale_artists': stale_artists,
+            'stale_tracks': stale_tracks,
+            'paused': int(self.paused)}
+
+    def run(self):
+        print("STARTING REFRESHER THREAD")
+        while True:
+            self.refresh_tracks()
+            self.refresh_artists()
+            sleep(self.pass_interval)
 
 
 class Similarity(object):
@@ -475,6 +2552,8 @@ class Similarity(object):
         data_dir = player_get_data_dir()
         self.db_path = os.path.join(data_dir, "similarity.db")
         self.gaia_db_path = os.path.join(data_dir, "gaia.db")
+        self.acoustic_db_path = os.path.join(data_dir, "acoustic.npz")
+        self.analysis_cache_path = os.path.join(data_dir, "analysis.db")
         self.db_queue = PriorityQueue()
         self._db_wrapper = DatabaseWrapper()
         self._db_wrapper.daemon = True
@@ -482,12 +2561,36 @@ class Similarity(object):
         self._db_wrapper.set_queue(self.db_queue)
         self._db_wrapper.start()
         self.create_db()
-        self.network = LastFMNetwork(api_key=API_KEY)
+        self._readers = ReaderPool(self.db_path)
+        self._artist_ids = IdCache()
+        self._track_ids = IdCache()
+        self.warm_id_caches()
+        self.fetcher = LastFMFetcher(api_key=API_KEY)
         self.cache_time = 90
-        if GAIA:
-            self.gaia_queue = LifoQueue()
+        # Answer from expired data right away and refresh it in the
+        # background, when there is any.
+        self.stale_while_revalidate = True
+        self._refreshing = set()
+        self._refreshing_lock = Lock()
+        self.interactive_lookups = 0
+        self.last_interactive = time()
+        self.interactive_lock = Lock()
+        self.refresher = Refresher(self)
+        self.refresher.daemon = True
+        self.refresher.start()
+        self.gaia_queue = AnalysisQueue()
+        self.gaia_analyser = None
+        if not extractor_available(ESSENTIA_EXTRACTOR_PATH):
+            print("no essentia extractor at %s, acoustic similarity is off" %
+                  ESSENTIA_EXTRACTOR_PATH)
+        elif ACOUSTIC_BACKEND == 'gaia' and GAIA:
             self.gaia_analyser = GaiaAnalysis(
-                self.gaia_db_path, self.gaia_queue)
+                self.gaia_db_path, self.gaia_queue, self.analysis_cache_path)
+        elif ACOUSTIC_BACKEND == 'numpy' and NUMPY:
+            self.gaia_analyser = NumpyAnalysis(
+                self.acoustic_db_path, self.gaia_queue,
+                self.analysis_cache_path)
+        if self.gaia_analyser is not None:
             self.gaia_analyser.daemon = True
             self.gaia_analyser.start()
 
@@ -503,16 +2606,26 @@ class Similarity(object):
         self.execute_sql(command=command, priority=priority)
         return command
 
+    def query(self, sql):
+        """Run a SELECT statement on a read only connection."""
+        return self._readers.execute(sql)
+
     def remove_track_by_filename(self, filename):
         if not filename:
             return
-        if GAIA:
+        if self.gaia_analyser is not None:
             self.gaia_queue.put((REMOVE, filename))
 
     def get_ordered_gaia_tracks_by_request(self, filename, number, request):
+        return self.get_ordered_gaia_tracks_by_requests(
+            filename, number, [request])
+
+    def get_ordered_gaia_tracks_by_requests(self, filename, number,
+                                            requests):
+        """Get neighbours for track, closest to any of the requests."""
         start_time = time()
         tracks = self.gaia_analyser.get_tracks(
-            filename, number, request=request)
+            filename, number, requests=requests)
         print("finding gaia matches took %f s" % (time() - start_time,))
         return tracks
 
@@ -523,37 +2636,250 @@ class Similarity(object):
         print("finding gaia matches took %f s" % (time() - start_time,))
         return tracks
 
-    def get_artist(self, artist_name):
-        """Get artist information from the database."""
-        sql = ("SELECT * FROM artists WHERE name = ?;", (artist_name,))
-        command = self.get_sql_command(sql, priority=1)
+    def warm_id_caches(self):
+        """Fill the id caches with the most recently updated entries."""
+        rows = self.query((
+            "SELECT name, id FROM artists ORDER BY updated DESC LIMIT ?;",
+            (self._artist_ids.size,)))
+        for name, artist_id in reversed(rows):
+            self._artist_ids.set(name, artist_id)
+        rows = self.query((
+            "SELECT artists.name, tracks.title, tracks.id FROM tracks INNER"
+            " JOIN artists ON artists.id = tracks.artist ORDER BY"
+            " tracks.updated DESC LIMIT ?;",
+            (self._track_ids.size,)))
+        for artist_name, title, track_id in reversed(rows):
+            self._track_ids.set((artist_name, title), track_id)
+
+    def get_artist_id(self, artist_name):
+        """Get the id of an artist, adding the artist if needed."""
+        artist_id = self._artist_ids.get(artist_name)
+        if artist_id is not None:
+            return artist_id
+        # Only go through the writer when the artist is not there yet.
+        for row in self.query((
+                "SELECT id FROM artists WHERE name = ?;", (artist_name,))):
+            artist_id = row[0]
+            self._artist_ids.set(artist_name, artist_id)
+            return artist_id
+        sql = (
+            "INSERT INTO artists (name) VALUES (?) ON CONFLICT (name) DO"
+            " UPDATE SET name = excluded.name RETURNING id;",
+            (artist_name,))
+        command = self.get_sql_command(sql, priority=0)
         for row in command.result_queue.get():
-            return row
-        sql2 = ("INSERT INTO artists (name) VALUES (?);", (artist_name,))
-        command = self.get_sql_command(sql2, priority=0)
-        command.result_queue.get()
-        command = self.get_sql_command(sql, priority=1)
+            artist_id = row[0]
+            self._artist_ids.set(artist_name, artist_id)
+        return artist_id
+
+    def get_track_id(self, artist_name, title):
+        """Get the id of a track, adding the track if needed."""
+        track_id = self._track_ids.get((artist_name, title))
+        if track_id is not None:
+            return track_id
+        artist_id = self.get_artist_id(artist_name)
+        # Only go through the writer when the track is not there yet.
+        for row in self.query((
+                "SELECT id FROM tracks WHERE artist = ? AND title = ?;",
+                (artist_id, title))):
+            track_id = row[0]
+            self._track_ids.set((artist_name, title), track_id)
+            return track_id
+        sql = (
+            "INSERT INTO tracks (artist, title) VALUES (?, ?) ON CONFLICT"
+            " (artist, title) DO UPDATE SET title = excluded.title RETURNING"
+            " id;",
+            (artist_id, title))
+        command = self.get_sql_command(sql, priority=2)
         for row in command.result_queue.get():
+            track_id = row[0]
+            self._track_ids.set((artist_name, title), track_id)
+        return track_id
+
+    def get_artist_ids(self, artist_names):
+        """Get a mapping of artist names to ids, adding missing artists."""
+        ids = {}
+        missing = []
+        for artist_name in set(artist_names):
+            artist_id = self._artist_ids.get(artist_name)
+            if artist_id is None:
+                missing.append(artist_name)
+            else:
+                ids[artist_name] = artist_id
+        for chunk in chunked(missing):
+            command = SQLTransaction([
+                SQLCommand((
+                    "INSERT INTO artists (name) VALUES (?) ON CONFLICT (name)"
+                    " DO NOTHING;",
+                    [(artist_name,) for artist_name in chunk]), many=True),
+                SQLCommand((
+                    "SELECT name, id FROM artists WHERE name IN (%s);" %
+                    ', '.join('?' * len(chunk)),
+                    chunk))])
+            self.execute_sql(command=command, priority=0)
+            for artist_name, artist_id in command.result_queue.get():
+                ids[artist_name] = artist_id
+                self._artist_ids.set(artist_name, artist_id)
+        return ids
+
+    def get_track_ids(self, tracks):
+        """Get a mapping of (artist name, title) pairs to track ids.
+
+        Missing artists and tracks are added.
+
+        """
+        ids = {}
+        missing = []
+        for track in set(tracks):
+            track_id = self._track_ids.get(track)
+            if track_id is None:
+                missing.append(track)
+            else:
+                ids[track] = track_id
+        artist_ids = self.get_artist_ids(
+            [artist_name for artist_name, _ in missing])
+        artist_names = {
+            artist_id: artist_name
+            for artist_name, artist_id in artist_ids.items()}
+        for chunk in chunked(missing):
+            rows = [(artist_ids[artist_name], title)
+                    for artist_name, title in chunk]
+            command = SQLTransaction([
+                SQLCommand((
+                    "INSERT INTO tracks (artist, title) VALUES (?, ?) ON"
+                    " CONFLICT (artist, title) DO NOTHING;",
+                    rows), many=True),
+                SQLCommand((
+                    "SELECT artist, title, id FROM tracks WHERE (artist,"
+                    " title) IN (VALUES %s);" %
+                    ', '.join(['(?, ?)'] * len(rows)),
+                    [value for row in rows for value in row]))])
+            self.execute_sql(command=command, priority=2)
+            for artist_id, title, track_id in command.result_queue.get():
+                track = (artist_names[artist_id], title)
+                ids[track] = track_id
+                self._track_ids.set(track, track_id)
+        return ids
+
+    def get_artist(self, artist_name):
+        """Get artist information from the database."""
+        sql = (
+            "SELECT * FROM artists WHERE id = ?;",
+            (self.get_artist_id(artist_name),))
+        for row in self.query(sql):
             return row
 
     def get_track_from_artist_and_title(self, artist_name, title):
         """Get track information from the database."""
-        artist_id = self.get_artist(artist_name)[0]
         sql = (
-            "SELECT * FROM tracks WHERE artist = ? AND title = ?;",
-            (artist_id, title))
-        command = self.get_sql_command(sql, priority=3)
-        for row in command.result_queue.get():
-            return row
-        sql2 = (
-            "INSERT INTO tracks (artist, title) VALUES (?, ?);",
-            (artist_id, title))
-        command = self.get_sql_command(sql2, priority=2)
-        command.result_queue.get()
-        command = self.get_sql_command(sql, priority=3)
-        for row in command.result_queue.get():
+            "SELECT * FROM tracks WHERE id = ?;",
+            (self.get_track_id(artist_name, title),))
+        for row in self.query(sql):
             return row
 
+    def get_cache_cutoff(self):
+        """Get the epoch time before which cached scores are stale."""
+        return int(time()) - self.cache_time * DAY
+
+    def is_artist_fresh(self, artist_id):
+        """Check whether the similar artists of an artist are cached."""
+        sql = (
+            "SELECT 1 FROM artists WHERE id = ? AND updated >= ?;",
+            (artist_id, self.get_cache_cutoff()))
+        return bool(self.query(sql))
+
+    def is_track_fresh(self, track_id):
+        """Check whether the similar tracks of a track are cached."""
+        sql = (
+            "SELECT 1 FROM tracks WHERE id = ? AND updated >= ?;",
+            (track_id, self.get_cache_cutoff()))
+        return bool(self.query(sql))
+
+    def is_artist_expired(self, artist_id):
+        """Check whether the similar artists of an artist have expired."""
+        sql = (
+            "SELECT 1 FROM artists WHERE id = ? AND updated < ?;",
+            (artist_id, self.get_cache_cutoff()))
+        return bool(self.query(sql))
+
+    def is_track_expired(self, track_id):
+        """Check whether the similar tracks of a track have expired."""
+        sql = (
+            "SELECT 1 FROM tracks WHERE id = ? AND updated < ?;",
+            (track_id, self.get_cache_cutoff()))
+        return bool(self.query(sql))
+
+    def is_known_miss(self, kind, item_id):
+        """Check whether last.fm recently had nothing for a track or artist.
+
+        kind is 'track' or 'artist'.
+
+        """
+        sql = (
+            "SELECT 1 FROM lastfm_misses WHERE kind = ? AND item = ? AND"
+            " retry_after > ?;",
+            (kind, item_id, int(time())))
+        return bool(self.query(sql))
+
+    def record_miss(self, kind, item_id, reason):
+        """Remember that last.fm had nothing for a track or artist."""
+        self.execute_sql((
+            "INSERT INTO lastfm_misses (kind, item, reason, failures,"
+            " retry_after) VALUES (:kind, :item, :reason, 1, :now + :ttl) ON"
+            " CONFLICT (kind, item) DO UPDATE SET reason = excluded.reason,"
+            " failures = failures + 1, retry_after = :now + MIN(:max, :ttl <<"
+            " MIN(failures, 16));",
+            {'kind': kind, 'item': item_id, 'reason': reason,
+             'now': int(time()), 'ttl': MISS_TTL[reason],
+             'max': self.cache_time * DAY}), priority=10)
+
+    def get_stale_artists(self, number, after=(-1, 0)):
+        """Get the artists whose similar artists expired longest ago.
+
+        Returns (name, id, updated) tuples, ordered by (updated, id) and
+        starting after the given (updated, id). Artists that last.fm
+        recently had nothing for are left out.
+
+        """
+        sql = (
+            "SELECT name, id, updated FROM artists WHERE updated < :cutoff"
+            " AND (updated, id) > (:updated, :id) AND NOT EXISTS (SELECT 1"
+            " FROM lastfm_misses WHERE kind = 'artist' AND item = artists.id"
+            " AND retry_after > :now) ORDER BY updated, id LIMIT :number;",
+            {'cutoff': self.get_cache_cutoff(), 'updated': after[0],
+             'id': after[1], 'now': int(time()), 'number': number})
+        return self.query(sql)
+
+    def get_stale_tracks(self, number, after=(-1, 0)):
+        """Get the tracks whose similar tracks expired longest ago.
+
+        Returns (artist name, title, id, updated) tuples, ordered by
+        (updated, id) and starting after the given (updated, id). Tracks
+        that last.fm recently had nothing for are left out.
+
+        """
+        sql = (
+            "SELECT artists.name, tracks.title, tracks.id, tracks.updated"
+            " FROM tracks INNER JOIN artists ON artists.id = tracks.artist"
+            " WHERE tracks.updated < :cutoff AND (tracks.updated, tracks.id) >"
+            " (:updated, :id) AND NOT EXISTS (SELECT 1 FROM lastfm_misses"
+            " WHERE kind = 'track' AND item = tracks.id AND retry_after >"
+            " :now) ORDER BY tracks.updated, tracks.id LIMIT :number;",
+            {'cutoff': self.get_cache_cutoff(), 'updated': after[0],
+             'id': after[1], 'now': int(time()), 'number': number})
+        return self.query(sql)
+
+    def count_stale(self):
+        """Count the expired artists and tracks."""
+        cutoff = self.get_cache_cutoff()
+        return (
+            self.query((
+                "SELECT count(*) FROM artists WHERE updated < ?;",
+                (cutoff,)))[0][0],
+            self.query((
+                "SELECT count(*) FROM tracks WHERE updated < ?;",
+                (cutoff,)))[0][0])
+
     def get_similar_tracks(self, track_id):
         """Get similar tracks from the database.
 
@@ -564,15 +2890,10 @@ class Similarity(object):
             "SELECT track_2_track.match, artists.name, tracks.title"
             " FROM track_2_track INNER JOIN tracks ON"
             " track_2_track.track2 = tracks.id INNER JOIN artists ON"
-            " artists.id = tracks.artist WHERE track_2_track.track1 = ? UNION "
-            "SELECT track_2_track.match, artists.name, tracks.title"
-            " FROM track_2_track INNER JOIN tracks ON"
-            " track_2_track.track1 = tracks.id INNER JOIN artists ON"
-            " artists.id = tracks.artist WHERE track_2_track.track2"
-            " = ? ORDER BY track_2_track.match DESC;",
-            (track_id, track_id))
-        command = self.get_sql_command(sql, priority=0)
-        return command.result_queue.get()
+            " artists.id = tracks.artist WHERE track_2_track.track1 = ?"
+            " ORDER BY track_2_track.match DESC;",
+            (track_id,))
+        return self.query(sql)
 
     def get_similar_artists(self, artist_id):
         """Get similar artists from the database.
@@ -583,102 +2904,72 @@ class Similarity(object):
         sql = (
             "SELECT match, name FROM artist_2_artist INNER JOIN"
             " artists ON artist_2_artist.artist2 = artists.id WHERE"
-            " artist_2_artist.artist1 = ? UNION "
-            "SELECT match, name FROM artist_2_artist INNER JOIN"
-            " artists ON artist_2_artist.artist1 = artists.id WHERE"
-            " artist_2_artist.artist2 = ? ORDER BY match DESC;",
-            (artist_id, artist_id))
-        command = self.get_sql_command(sql, priority=0)
-        return command.result_queue.get()
-
-    def get_artist_match(self, artist1, artist2):
-        """Get artist match score from database."""
-        sql = (
-            "SELECT match FROM artist_2_artist WHERE artist1 = ?"
-            " AND artist2 = ?;",
-            (artist1, artist2))
-        command = self.get_sql_command(sql, priority=2)
-        for row in command.result_queue.get():
-            return row[0]
-        return 0
-
-    def get_track_match(self, track1, track2):
-        """Get track match score from database."""
-        sql = (
-            "SELECT match FROM track_2_track WHERE track1 = ? AND track2 = ?;",
-            (track1, track2))
-        command = self.get_sql_command(sql, priority=2)
-        for row in command.result_queue.get():
-            return row[0]
-        return 0
-
-    def update_artist_match(self, artist1, artist2, match):
-        """Write match score to the database."""
-        self.execute_sql((
-            "UPDATE artist_2_artist SET match = ? WHERE artist1 = ? AND"
-            " artist2 = ?;",
-            (match, artist1, artist2)), priority=10)
-
-    def update_track_match(self, track1, track2, match):
-        """Write match score to the database."""
-        self.execute_sql((
-            "UPDATE track_2_track SET match = ? WHERE track1 = ? AND"
-            " track2 = ?;",
-            (match, track1, track2)), priority=10)
-
-    def insert_artist_match(self, artist1, artist2, match):
-        """Write match score to the database."""
-        self.execute_sql((
-            "INSERT INTO artist_2_artist (artist1, artist2, match) VALUES"
-            " (?, ?, ?);",
-            (artist1, artist2, match)), priority=10)
-
-    def insert_track_match(self, track1, track2, match):
-        """Write match score to the database."""
-        self.execute_sql((
-            "INSERT INTO track_2_track (track1, track2, match) VALUES"
-            " (?, ?, ?);",
-            (track1, track2, match)), priority=10)
+            " artist_2_artist.artist1 = ? ORDER BY match DESC;",
+            (artist_id,))
+        return self.query(sql)
 
-    def update_artist(self, artist_id):
-        """Write artist information to the database."""
-        self.execute_sql((
-            "UPDATE artists SET updated = DATETIME('now') WHERE id = ?;",
-            (artist_id,)), priority=10)
+    def update_similar_artists(self, artists_to_update):
+        """Write similar artist information to the database.
 
-    def update_track(self, track_id):
-        """Write track information to the database."""
-        self.execute_sql((
-            "UPDATE tracks SET updated = DATETIME('now') WHERE id = ?",
-            (track_id,)), priority=10)
+        All scores are written in both directions in a single transaction.
 
-    def update_similar_artists(self, artists_to_update):
-        """Write similar artist information to the database."""
-        for artist_id, similar in list(artists_to_update.items()):
+        """
+        ids = self.get_artist_ids([
+            artist['artist'] for similar in artists_to_update.values()
+            for artist in similar])
+        rows = []
+        for artist_id, similar in artists_to_update.items():
             for artist in similar:
-                row = self.get_artist(artist['artist'])
-                if row:
-                    id2 = row[0]
-                    if self.get_artist_match(artist_id, id2):
-                        self.update_artist_match(
-                            artist_id, id2, artist['score'])
-                        continue
-                    self.insert_artist_match(artist_id, id2, artist['score'])
-            self.update_artist(artist_id)
+                id2 = ids[artist['artist']]
+                rows.append((artist_id, id2, artist['score']))
+                rows.append((id2, artist_id, artist['score']))
+        self.execute_sql(command=SQLTransaction([
+            SQLCommand((
+                "INSERT INTO artist_2_artist (artist1, artist2, match) VALUES"
+                " (?, ?, ?) ON CONFLICT (artist1, artist2) DO UPDATE SET"
+                " match = excluded.match;",
+                rows), many=True),
+            SQLCommand((
+                "UPDATE artists SET updated = CAST(strftime('%s', 'now') AS"
+                " INTEGER) WHERE id = ?;",
+                [(artist_id,) for artist_id in artists_to_update]),
+                many=True),
+            SQLCommand((
+                "DELETE FROM lastfm_misses WHERE kind = 'artist' AND item ="
+                " ?;",
+                [(artist_id,) for artist_id in artists_to_update]),
+                many=True)]), priority=10)
 
     def update_similar_tracks(self, tracks_to_update):
-        """Write similar track information to the database."""
-        for track_id, similar in list(tracks_to_update.items()):
+        """Write similar track information to the database.
+
+        All scores are written in both directions in a single transaction.
+
+        """
+        ids = self.get_track_ids([
+            (track['artist'], track['title'])
+            for similar in tracks_to_update.values() for track in similar])
+        rows = []
+        for track_id, similar in tracks_to_update.items():
             for track in similar:
-                row = self.get_track_from_artist_and_title(
-                    track['artist'], track['title'])
-                if row:
-                    id2 = row[0]
-                    if self.get_track_match(track_id, id2):
-                        self.update_track_match(track_id, id2, track['score'])
-                        continue
-                    self.insert_track_match(track_id, id2, track['score'])
-            self.update_track(track_id)
+                id2 = ids[(track['artist'], track['title'])]
+                rows.append((track_id, id2, track['score']))
+                rows.append((id2, track_id, track['score']))
+        self.execute_sql(command=SQLTransaction([
+            SQLCommand((
+                "INSERT INTO track_2_track (track1, track2, match) VALUES"
+                " (?, ?, ?) ON CONFLICT (track1, track2) DO UPDATE SET"
+                " match = excluded.match;",
+                rows), many=True),
+            SQLCommand((
+                "UPDATE tracks SET updated = CAST(strftime('%s', 'now') AS"
+                " INTEGER) WHERE id = ?;",
+                [(track_id,) for track_id in tracks_to_update]),
+                many=True),
+            SQLCommand((
+                "DELETE FROM lastfm_misses WHERE kind = 'track' AND item = ?;",
+                [(track_id,) for track_id in tracks_to_update]),
+                many=True)]), priority=10)
 
     def create_db(self):
         """Set up a database for the artist and track similarity scores."""
@@ -696,18 +2987,80 @@ class Similarity(object):
         self.execute_sql((
             'CREATE TABLE IF NOT EXISTS track_2_track (track1 INTEGER, track2'
             ' INTEGER, match INTEGER, UNIQUE(track1, track2));',), priority=0)
-        self.execute_sql((
-            "CREATE INDEX IF NOT EXISTS a2aa1x ON artist_2_artist "
-            "(artist1);",), priority=0)
         self.execute_sql((
             "CREATE INDEX IF NOT EXISTS a2aa2x ON artist_2_artist "
             "(artist2);",), priority=0)
-        self.execute_sql(
-            ("CREATE INDEX IF NOT EXISTS t2tt1x ON track_2_track (track1);",),
-            priority=0)
         self.execute_sql(
             ("CREATE INDEX IF NOT EXISTS t2tt2x ON track_2_track (track2);",),
             priority=0)
+        self.migrate_db()
+
+    def migrate_db(self):
+        """Bring the database schema up to date.
+
+        The schema version is kept in the user_version pragma, and every
+        migration runs in its own transaction.
+
+        """
+        migrations = [
+            self.store_symmetric_edges, self.store_epoch_updated,
+            self.create_misses_table]
+        command = self.get_sql_command(('PRAGMA user_version;',), priority=0)
+        version = command.result_queue.get()[0][0]
+        for number, migration in enumerate(migrations[version:], version + 1):
+            print("migrating similarity database to version %d" % number)
+            command = SQLTransaction(migration() + [
+                SQLCommand(('PRAGMA user_version = %d;' % number,))])
+            self.execute_sql(command=command, priority=0)
+            command.result_queue.get()
+
+    @staticmethod
+    def store_symmetric_edges():
+        """Store every similarity score in both directions.
+
+        The neighbours of a track or artist ordered by match are then a
+        single range scan of the (track1, match) or (artist1, match) index.
+
+        """
+        return [
+            SQLCommand((
+                "INSERT INTO artist_2_artist (artist1, artist2, match) SELECT"
+                " artist2, artist1, match FROM artist_2_artist WHERE true ON"
+                " CONFLICT (artist1, artist2) DO NOTHING;",)),
+            SQLCommand((
+                "INSERT INTO track_2_track (track1, track2, match) SELECT"
+                " track2, track1, match FROM track_2_track WHERE true ON"
+                " CONFLICT (track1, track2) DO NOTHING;",)),
+            SQLCommand(("DROP INDEX IF EXISTS a2aa1x;",)),
+            SQLCommand(("DROP INDEX IF EXISTS t2tt1x;",)),
+            SQLCommand((
+                "CREATE INDEX a2aa1mx ON artist_2_artist (artist1, match"
+                " DESC, artist2);",)),
+            SQLCommand((
+                "CREATE INDEX t2tt1mx ON track_2_track (track1, match DESC,"
+                " track2);",))]
+
+    @staticmethod
+    def store_epoch_updated():
+        """Store update times as integer epoch seconds, and index them."""
+        return [
+            SQLCommand((
+                "UPDATE artists SET updated = CAST(strftime('%s', updated) AS"
+                " INTEGER) WHERE typeof(updated) = 'text';",)),
+            SQLCommand((
+                "UPDATE tracks SET updated = CAST(strftime('%s', updated) AS"
+                " INTEGER) WHERE typeof(updated) = 'text';",)),
+            SQLCommand(("CREATE INDEX aupdx ON artists (updated);",)),
+            SQLCommand(("CREATE INDEX tupdx ON tracks (updated);",))]
+
+    @staticmethod
+    def create_misses_table():
+        """Add the table that remembers what last.fm had nothing for."""
+        return [
+            SQLCommand((
+                "CREATE TABLE lastfm_misses (kind TEXT, item INTEGER, reason"
+                " TEXT, failures INTEGER, retry_after INTEGER, PRIMARY KEY"
+                " (kind, item)) WITHOUT ROWID;",))]
 
     def delete_orphan_artist(self, artist):
         """Delete artists that have no tracks."""
@@ -718,137 +3071,266 @@ class Similarity(object):
         command = self.get_sql_command(sql, priority=10)
         for row in command.result_queue.get():
             artist_id = row[0]
+            self._artist_ids.discard(artist)
             self.execute_sql((
                 'DELETE FROM artist_2_artist WHERE artist1 = ? OR artist2 = '
                 '?;', (artist_id, artist_id)), priority=10)
+            self.execute_sql((
+                "DELETE FROM lastfm_misses WHERE kind = 'artist' AND item ="
+                " ?;", (artist_id,)), priority=10)
             self.execute_sql(
                 ('DELETE FROM artists WHERE id = ?', (artist_id,)),
                 priority=10)
 
-    def analyze_track(self, filename):
+    def analyze_track(self, filename, priority=NOW_PLAYING):
         """Perform gaia analysis of a track."""
         if not filename:
             return
-        if GAIA:
-            self.gaia_queue.put((ADD, filename))
+        if priority not in PRIORITIES:
+            raise ValueError('unknown analysis priority: %s' % priority)
+        if self.gaia_analyser is not None:
+            self.gaia_analyser.analyze([filename], priority)
 
-    def analyze_tracks(self, filenames):
+    def analyze_tracks(self, filenames, priority=BULK):
         """Analyze audio files."""
         if not filenames:
             return
-        if GAIA:
-            for filename in filenames:
-                self.gaia_queue.put((ADD, filename))
+        if priority not in PRIORITIES:
+            raise ValueError('unknown analysis priority: %s' % priority)
+        if self.gaia_analyser is not None:
+            self.gaia_analyser.analyze(filenames, priority)
+
+    def get_analysis_queue_depths(self):
+        """Get the number of files waiting for analysis per priority."""
+        if self.gaia_analyser is None:
+            return {}
+        depths = self.gaia_queue.depths()
+        depths['extracting'] = len(self.gaia_analyser.extracting)
+        return depths
 
     def get_similar_tracks_from_lastfm(self, artist_name, title, track_id,
-                                       cutoff=0):
-        """Get similar tracks."""
+                                       cutoff=0, lookup=None):
+        """Get similar tracks.
+
+        lookup is an already submitted fetcher call for the track.
+
+        """
+        if lookup is None:
+            lookup = self.fetcher.get_similar_tracks(artist_name, title)
         try:
-            lastfm_track = self.network.get_track(artist_name, title)
+            similar_tracks = lookup.result()
         except (WSError, NetworkError, MalformedResponseError) as e:
             print(e)
+            reason = classify_miss(e)
+            if reason:
+                self.record_miss('track', track_id, reason)
+            return []
+        if not similar_tracks:
+            self.record_miss('track', track_id, 'empty')
             return []
         tracks_to_update = {}
         results = []
-        try:
-            for similar in lastfm_track.get_similar():
-                match = int(100 * similar.match)
-                if match <= cutoff:
-                    continue
-                item = similar.item
-                similar_artist = item.artist.get_name()
-                similar_title = item.title
-                tracks_to_update.setdefault(track_id, []).append({
-                    'score': match,
-                    'artist': similar_artist,
-                    'title': similar_title})
-                results.append((match, similar_artist, similar_title))
-        except (WSError, NetworkError, MalformedResponseError) as e:
-            print(e)
-            return []
+        for match, similar_artist, similar_title in similar_tracks:
+            match = int(100 * match)
+            if match <= cutoff:
+                continue
+            tracks_to_update.setdefault(track_id, []).append({
+                'score': match,
+                'artist': similar_artist,
+                'title': similar_title})
+            results.append((match, similar_artist, similar_title))
         self.update_similar_tracks(tracks_to_update)
         return results
 
     def get_similar_artists_from_lastfm(self, artist_name, artist_id,
-                                        cutoff=0):
-        """Get similar artists from lastfm."""
+                                        cutoff=0, lookup=None):
+        """Get similar artists from lastfm.
+
+        lookup is an already submitted fetcher call for the artist.
+
+        """
+        if lookup is None:
+            lookup = self.fetcher.get_similar_artists(artist_name)
         try:
-            lastfm_artist = self.network.get_artist(artist_name)
+            similar_artists = lookup.result()
         except (WSError, NetworkError, MalformedResponseError) as e:
             print(e)
+            reason = classify_miss(e)
+            if reason:
+                self.record_miss('artist', artist_id, reason)
+            return []
+        if not similar_artists:
+            self.record_miss('artist', artist_id, 'empty')
             return []
         artists_to_update = {}
         results = []
-        try:
-            for similar in lastfm_artist.get_similar():
-                match = int(100 * similar.match)
-                if match <= cutoff:
-                    continue
-                name = similar.item.get_name()
-                artists_to_update.setdefault(artist_id, []).append({
-                    'score': match,
-                    'artist': name})
-                results.append((match, name))
-        except (WSError, NetworkError, MalformedResponseError) as e:
-            print(e)
-            return []
+        for match, name in similar_artists:
+            match = int(100 * match)
+            if match <= cutoff:
+                continue
+            artists_to_update.setdefault(artist_id, []).append({
+                'score': match,
+                'artist': name})
+            results.append((match, name))
         self.update_similar_artists(artists_to_update)
         return results
 
+    def is_idle(self, seconds):
+        """Check whether nobody has been waiting for a lookup for a while."""
+        with self.interactive_lock:
+            return (
+                not self.interactive_lookups and
+                time() - self.last_interactive >= seconds and
+                not self.fetcher.pending())
+
+    def refresh_in_background(self, key, lookup, write_back):
+        """Write back a last.fm lookup when it completes.
+
+        At most one refresh per key is in progress at any time.
+
+        """
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def done(finished):
+            try:
+                write_back(finished)
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(key)
+
+        lookup.add_done_callback(done)
+
+    def refresh_similar_tracks(self, artist_name, title, track_id):
+        """Update the similar tracks of a track in the background."""
+        self.refresh_in_background(
+            ('track', track_id),
+            self.fetcher.get_similar_tracks(artist_name, title),
+            lambda lookup: self.get_similar_tracks_from_lastfm(
+                artist_name, title, track_id, lookup=lookup))
+
+    def refresh_similar_artists(self, artist_name, artist_id):
+        """Update the similar artists of an artist in the background."""
+        self.refresh_in_background(
+            ('artist', artist_id),
+            self.fetcher.get_similar_artists(artist_name),
+            lambda lookup: self.get_similar_artists_from_lastfm(
+                artist_name, artist_id, lookup=lookup))
+
+    @interactive
     def get_ordered_similar_tracks(self, artist_name, title):
         """Get similar tracks from last.fm/the database.
 
         Sorted by descending match score.
 
         """
-        now = datetime.now()
-        track = self.get_track_from_artist_and_title(
-            artist_name, title)
-        track_id, updated = track[0], track[3]
-        if updated:
-            updated = datetime(*strptime(updated, "%Y-%m-%d %H:%M:%S")[0:6])
-            if updated + timedelta(self.cache_time) > now:
+        track_id = self.get_track_id(artist_name, title)
+        if self.is_track_fresh(track_id):
+            print(
+                "Getting similar tracks from db for: %s - %s" % (
+                    artist_name, title))
+            return self.get_similar_tracks(track_id)
+        if self.is_known_miss('track', track_id):
+            print(
+                "Not asking last.fm again yet for: %s - %s" % (
+                    artist_name, title))
+            return self.get_similar_tracks(track_id)
+        if self.stale_while_revalidate and self.is_track_expired(track_id):
+            results = self.get_similar_tracks(track_id)
+            if results:
                 print(
-                    "Getting similar tracks from db for: %s - %s" % (
+                    "Getting expired similar tracks from db for: %s - %s" % (
                         artist_name, title))
-                return self.get_similar_tracks(track_id)
+                self.refresh_similar_tracks(artist_name, title, track_id)
+                return results
         return self.get_similar_tracks_from_lastfm(
             artist_name, title, track_id)
 
+    @interactive
     def get_ordered_similar_artists(self, artists):
         """Get similar artists from the database.
 
-        Sorted by descending match score.
+        Sorted by descending match score. Artists that are not in the
+        database are looked up on last.fm in parallel.
 
         """
         results = []
-        now = datetime.now()
-        for name in artists:
-            artist_name = name
-            result = None
-            artist = self.get_artist(artist_name)
-            artist_id, updated = artist[0], artist[2]
-            if updated:
-                updated = datetime(
-                    *strptime(updated, "%Y-%m-%d %H:%M:%S")[0:6])
-                if updated + timedelta(self.cache_time) > now:
+        lookups = []
+        for artist_name in artists:
+            artist_id = self.get_artist_id(artist_name)
+            if self.is_artist_fresh(artist_id):
+                print(
+                    "Getting similar artists from db for: %s " %
+                    artist_name)
+                result = self.get_similar_artists(artist_id)
+                if result:
+                    results.extend(result)
+                    continue
+            elif self.is_known_miss('artist', artist_id):
+                print("Not asking last.fm again yet for: %s" % artist_name)
+                results.extend(self.get_similar_artists(artist_id))
+                continue
+            elif (self.stale_while_revalidate and
+                  self.is_artist_expired(artist_id)):
+                result = self.get_similar_artists(artist_id)
+                if result:
                     print(
-                        "Getting similar artists from db for: %s " %
+                        "Getting expired similar artists from db for: %s" %
                         artist_name)
-                    result = self.get_similar_artists(artist_id)
-            if not result:
-                result = self.get_similar_artists_from_lastfm(
-                    artist_name, artist_id)
-            results.extend(result)
+                    self.refresh_similar_artists(artist_name, artist_id)
+                    results.extend(result)
+                    continue
+            lookups.append((
+                artist_name, artist_id,
+                self.fetcher.get_similar_artists(artist_name)))
+        for artist_name, artist_id, lookup in lookups:
+            results.extend(self.get_similar_artists_from_lastfm(
+                artist_name, artist_id, lookup=lookup))
         results.sort(reverse=True)
         return results
 
-    def miximize(self, filenames):
-        """Return ideally ordered list of filenames."""
-        if not GAIA:
-            return []
+    def miximize(self, filenames, timeout=MIXIMIZE_TIMEOUT, partial=True,
+                 refine_time=0):
+        """Order files by acoustic similarity, once they are analyzed.
+
+        Returns a future for the list of indices into filenames and the
+        length of the path along them before and after refining it for up
+        to refine_time seconds. Files that are not analyzed after timeout
+        seconds are put at the end, unless partial is False, in which case
+        the future fails.
+
+        """
+        result = Future()
+        if self.gaia_analyser is None:
+            result.set_result(([], 0.0, 0.0))
+            return result
+        order = []
+
+        def done(_, before, after):
+            result.set_result((order, before, after))
+
+        def failed(_, message):
+            result.set_exception(RuntimeError(message))
+
+        self.start_miximize(
+            filenames, progress=lambda *args: None,
+            chunk=lambda _, chunk: order.extend(chunk), done=done,
+            failed=failed, timeout=timeout, partial=partial,
+            refine_time=refine_time, chunk_size=None)
+        return result
 
-        return self.gaia_analyser.get_miximized_tracks(filenames)
+    def start_miximize(self, filenames, progress, chunk, done, failed,
+                       timeout=MIXIMIZE_TIMEOUT, partial=True, refine_time=0,
+                       chunk_size=MIXIMIZE_CHUNK_SIZE):
+        """Start a MiximizeJob for files, and return its id."""
+        job = MiximizeJob(
+            self.gaia_analyser, filenames, progress, chunk, done, failed,
+            timeout=timeout, partial=partial, refine_time=refine_time,
+            chunk_size=chunk_size)
+        job.start()
+        return job.id
 
 
 class SimilarityService(dbus.service.Object):
@@ -877,6 +3359,16 @@ class SimilarityService(dbus.service.Object):
         self.similarity.analyze_tracks([
             str(filename) for filename in filenames])
 
+    @method(dbus_interface=IFACE, in_signature='ss')
+    def analyze_track_with_priority(self, filename, priority):
+        """Perform analysis of a track, with a priority from PRIORITIES."""
+        self.similarity.analyze_track(str(filename), priority=str(priority))
+
+    @method(dbus_interface=IFACE, out_signature='a{si}')
+    def get_analysis_queue_depths(self):
+        """Get the number of files waiting for analysis per priority."""
+        return self.similarity.get_analysis_queue_depths()
+
     @method(dbus_interface=IFACE, in_signature='si', out_signature='a(is)')
     def get_ordered_gaia_tracks(self, filename, number):
         """Get similar tracks by gaia acoustic analysis."""
@@ -889,6 +3381,13 @@ class SimilarityService(dbus.service.Object):
         return self.similarity.get_ordered_gaia_tracks_by_request(
             str(filename), number, str(request))
 
+    @method(dbus_interface=IFACE, in_signature='sias', out_signature='a(is)')
+    def get_ordered_gaia_tracks_by_requests(self, filename, number, requests):
+        """Get similar tracks by gaia acoustic analysis, closest to any of
+        the requested tracks."""
+        return self.similarity.get_ordered_gaia_tracks_by_requests(
+            str(filename), number, [str(request) for request in requests])
+
     @method(dbus_interface=IFACE, in_signature='ss', out_signature='a(iss)')
     def get_ordered_similar_tracks(self, artist_name, title):
         """Get similar tracks from last.fm/the database.
@@ -909,15 +3408,93 @@ class SimilarityService(dbus.service.Object):
         return self.similarity.get_ordered_similar_artists(
             [str(a) for a in artists])
 
-    @method(dbus_interface=IFACE, in_signature='as', out_signature='ai')
-    def miximize(self, filenames):
+    @method(dbus_interface=IFACE, in_signature='as', out_signature='ai',
+            async_callbacks=('reply_handler', 'error_handler'))
+    def miximize(self, filenames, reply_handler, error_handler):
         """Return ideally ordered list of filenames."""
-        return self.similarity.miximize([str(f) for f in filenames])
+        reply_when_done(
+            self.similarity.miximize([str(f) for f in filenames]),
+            lambda result: reply_handler(result[0]), error_handler)
+
+    @method(dbus_interface=IFACE, in_signature='asdb', out_signature='ai',
+            async_callbacks=('reply_handler', 'error_handler'))
+    def miximize_with_timeout(self, filenames, timeout, partial,
+                              reply_handler, error_handler):
+        """Return ideally ordered list of filenames.
+
+        Waits at most timeout seconds for the files to be analyzed, after
+        which only the analyzed files are ordered, or an error is returned
+        if partial is false.
+
+        """
+        reply_when_done(
+            self.similarity.miximize(
+                [str(f) for f in filenames], timeout=timeout,
+                partial=bool(partial)),
+            lambda result: reply_handler(result[0]), error_handler)
+
+    @method(dbus_interface=IFACE, in_signature='asdbd', out_signature='aidd',
+            async_callbacks=('reply_handler', 'error_handler'))
+    def miximize_refined(self, filenames, timeout, partial, refine_time,
+                         reply_handler, error_handler):
+        """Return ideally ordered list of filenames, like
+        miximize_with_timeout, after spending up to refine_time seconds on
+        shortening the path along them.
+
+        Also returns the total distance along the path before and after.
+
+        """
+        reply_when_done(
+            self.similarity.miximize(
+                [str(f) for f in filenames], timeout=timeout,
+                partial=bool(partial), refine_time=refine_time),
+            lambda result: reply_handler(*result), error_handler)
+
+    @method(dbus_interface=IFACE, in_signature='asdbdi', out_signature='i')
+    def start_miximize(self, filenames, timeout, partial, refine_time,
+                       chunk_size):
+        """Start ordering filenames like miximize_refined, in the background.
+
+        Returns a job id. The progress of the job, the order in chunks of
+        chunk_size indices (or in one go for 0) as they become final, and
+        its end are reported through the miximize_progress,
+        miximize_chunk, and miximize_done or miximize_failed signals.
+
+        """
+        return self.similarity.start_miximize(
+            [str(f) for f in filenames],
+            progress=in_main_loop(self.miximize_progress),
+            chunk=in_main_loop(self.miximize_chunk),
+            done=in_main_loop(self.miximize_done),
+            failed=in_main_loop(self.miximize_failed), timeout=timeout,
+            partial=bool(partial), refine_time=refine_time,
+            chunk_size=chunk_size)
+
+    @signal(dbus_interface=IFACE, signature='isii')
+    def miximize_progress(self, job, stage, done, total):
+        """Files of a miximize job that have been analyzed or ordered."""
+
+    @signal(dbus_interface=IFACE, signature='iai')
+    def miximize_chunk(self, job, indices):
+        """The next part of the order of a miximize job."""
+
+    @signal(dbus_interface=IFACE, signature='idd')
+    def miximize_done(self, job, length_before, length_after):
+        """A miximize job has handed out its complete order."""
+
+    @signal(dbus_interface=IFACE, signature='is')
+    def miximize_failed(self, job, message):
+        """A miximize job could not order its files."""
+
+    @method(dbus_interface=IFACE, out_signature='a{si}')
+    def get_refresh_progress(self):
+        """Report on the background refreshing of last.fm data."""
+        return self.similarity.refresher.get_progress()
 
     @method(dbus_interface=IFACE, out_signature='b')
     def has_gaia(self):
-        """Get gaia installation status."""
-        return GAIA
+        """Get whether acoustic similarity is available."""
+        return self.similarity.gaia_analyser is not None
 
     def run(self):
         """Run loop."""
@@ -7,9 +7,13 @@ from quodlibet import app
 from quodlibet.plugins.songsmenu import SongsMenuPlugin
 
 
-def no_op(*args, **kwargs):
-    pass
+# Seconds to wait for the songs to be analyzed, and to spend on improving
+# their order.
+MIXIMIZE_TIMEOUT = 60
+REFINE_TIME = 2
 
+# Number of songs to enqueue at a time.
+CHUNK_SIZE = 10
 
 DBusGMainLoop(set_as_default=True)
 
@@ -34,21 +38,53 @@ class MiximizePlugin(SongsMenuPlugin):
     PLUGIN_ICON = "gtk-find-and-replace"
     PLUGIN_VERSION = "0.1"
 
-    def player_enqueue(self, indices):
-        """Put the song at the end of the queue."""
-        app.window.playlist.enqueue([self._songs[index] for index in indices])
-        self._songs = None
+    # Shared by all instances, so that the signals are only handled once.
+    _similarity = None
+    _jobs = {}
+
+    @classmethod
+    def get_similarity(cls):
+        """Get the similarity service, listening to its miximize signals."""
+        if cls._similarity is None:
+            bus = dbus.SessionBus()
+            sim = bus.get_object(
+                'org.autoqueue', '/org/autoqueue/Similarity',
+                follow_name_owner_changes=True)
+            cls._similarity = dbus.Interface(
+                sim, dbus_interface='org.autoqueue.SimilarityInterface')
+            cls._similarity.connect_to_signal(
+                'miximize_chunk', cls.player_enqueue)
+            cls._similarity.connect_to_signal('miximize_done', cls.done)
+            cls._similarity.connect_to_signal('miximize_failed', cls.failed)
+        return cls._similarity
+
+    @classmethod
+    def player_enqueue(cls, job, indices):
+        """Put the next songs of a job at the end of the queue."""
+        songs = cls._jobs.get(job)
+        if songs is None:
+            return
+        app.window.playlist.enqueue([songs[index] for index in indices])
+
+    @classmethod
+    def done(cls, job, length_before, length_after):
+        """Forget about a finished job."""
+        cls._jobs.pop(job, None)
+
+    @classmethod
+    def failed(cls, job, message):
+        """Forget about a failed job."""
+        if cls._jobs.pop(job, None) is not None:
+            print(message)
 
     def plugin_songs(self, songs):
         """Send songs to dbus similarity service."""
-        bus = dbus.SessionBus()
-        self._songs = songs
-        sim = bus.get_object(
-            'org.autoqueue', '/org/autoqueue/Similarity',
-            follow_name_owner_changes=True)
-        similarity = dbus.Interface(
-            sim, dbus_interface='org.autoqueue.SimilarityInterface')
-        print([song['~filename'] for song in songs])
-        similarity.miximize(
-            [song['~filename'] for song in songs],
-            reply_handler=self.player_enqueue, error_handler=no_op)
+        filenames = [song['~filename'] for song in songs]
+        print(filenames)
+
+        def started(job):
+            self._jobs[job] = songs
+
+        self.get_similarity().start_miximize(
+            filenames, MIXIMIZE_TIMEOUT, True, REFINE_TIME, CHUNK_SIZE,
+            reply_handler=started, error_handler=print)
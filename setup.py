@@ -64,14 +64,15 @@ DistUtilsExtra.auto.setup(
     author_email='thisfred@gmail.com',
     url='https://launchpad.net/autoqueue',
     requires=[
-        'dateutil', 'pylast', 'pywapi', 'geohash', 'requests', 'nltk'],
+        'dateutil', 'pywapi', 'geohash', 'requests', 'nltk', 'numpy'],
     provides=['autoqueue'],
     cmdclass={
         'install': Install,
         'clean': Clean,
     },
     data_files=[
-        ('lib/autoqueue', ['bin/autoqueue-similarity-service']),
+        ('lib/autoqueue', [
+            'bin/autoqueue-similarity-service', 'bin/autoqueue-ann-benchmark']),
         ('share/dbus-1/services/', [SERVICE_FILE]),
         ('share/pyshared/quodlibet/plugins/events/',
          ['quodlibet_autoqueue.py']),